@@ -1,12 +1,26 @@
 from flask import Flask
+from PIL import Image as PILImage
 from flask_login import LoginManager
 from flask_sqlalchemy import SQLAlchemy
 from os import path
+from .thumbnails import ThumbnailCache
+from .jobs import JobQueue
+from .variants import VariantStore
+from .instrumentation import Metrics, DEFAULT_BUCKETS
+from .identity import UserCache, PasswordHasher
+import click
+import os
 
 db = SQLAlchemy()
+thumbnail_cache = ThumbnailCache()
+job_queue = JobQueue()
+variant_store = VariantStore()
+metrics = Metrics()
+user_cache = UserCache()
+password_hasher = PasswordHasher()
 DB_NAME = "image_manipulation.db"
 
-def create_app():
+def create_app(config=None):
     # Creating the Flask app
     app = Flask(__name__)
     # app.config['SECRET_KEY'] = os.getenv('SECRET_KEY') Standard way to get the secret key
@@ -16,12 +30,102 @@ def create_app():
     basedir = path.abspath(path.dirname(__file__))
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path.join(basedir, DB_NAME)
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-    db.init_app(app)
 
     # Configuring the upload folder
     UPLOAD_FOLDER = 'uploads'
     app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+    # Uploaded bytes are stored once under their content hash, upload names are hard links to them.
+    # The blob folder must be on the same file system as the upload folder
+    app.config['BLOB_FOLDER'] = path.join(UPLOAD_FOLDER, '.blobs')
+
+    # Configuring how files are sent: None streams them from Python, 'x-sendfile' or 'x-accel-redirect'
+    # leave the body to a front proxy. X-Accel-Redirect paths are the file path relative to
+    # SENDFILE_ROOT behind X_ACCEL_REDIRECT_PREFIX, which nginx maps to an internal location
+    app.config['SENDFILE_MODE'] = None
+    app.config['SENDFILE_ROOT'] = path.abspath('.')
+    app.config['X_ACCEL_REDIRECT_PREFIX'] = '/protected'
+
+    # Configuring the thumbnail cache, list pages use the first size and modify pages the second
+    app.config['THUMBNAIL_FOLDER'] = path.join('cache', 'thumbnails')
+    app.config['THUMBNAIL_SIZES'] = (200, 480)
+    app.config['THUMBNAIL_CACHE_MAX_BYTES'] = 64 * 1024 * 1024
+
+    # Configuring the encoders, see encoding.PRESETS. Edited images are saved with ENCODING_PRESET,
+    # thumbnails are encoded once and sent many times so they favour size. Browsers that accept
+    # WebP are sent WebP thumbnails when WEBP_THUMBNAILS is on
+    app.config['ENCODING_PRESET'] = 'balanced'
+    app.config['THUMBNAIL_PRESET'] = 'size'
+    app.config['WEBP_THUMBNAILS'] = True
+
+    # Configuring the live preview of the modify page, edits are previewed on a proxy of this size
+    # (kept in the thumbnail cache) and encoded with PREVIEW_PRESET
+    app.config['PREVIEW_SIZE'] = 1024
+    app.config['PREVIEW_PRESET'] = 'speed'
+
+    # Configuring the job queue, edits run on a pool of worker processes instead of the request thread
+    app.config['JOB_WORKERS'] = os.cpu_count()
+    app.config['JOB_QUEUE_LIMIT'] = 32
+    app.config['JOB_HISTORY_LIMIT'] = 1000
+
+    # Configuring the variant cache, edits are stored as history and rendered into this folder on demand
+    app.config['VARIANT_FOLDER'] = path.join('cache', 'variants')
+
+    # Configuring the image catalog, listings are paginated from the database instead of scanning the folder
+    app.config['CATALOG_PAGE_SIZE'] = 20
+    app.config['CATALOG_MAX_PAGE_SIZE'] = 100
+    app.config['CATALOG_RECONCILE_ON_STARTUP'] = True
+
+    # Configuring near-duplicate detection, uploads whose perceptual hashes differ in at most this many
+    # of their 64 bits are reported as the same picture. At most similarity.MAX_DISTANCE (7)
+    app.config['DUPLICATE_HASH_DISTANCE'] = 6
+    # Uploads that can't be hashed from a reduced decode (PNGs) are hashed on the job queue, the upload
+    # waits this many seconds for it and otherwise leaves the file to `flask hash-images`
+    app.config['UPLOAD_HASH_TIMEOUT'] = 5.0
+
+    # Configuring the metrics, /metrics is off until it is given addresses or a token. It serves them to
+    # requests from METRICS_ALLOWED_ADDRESSES and to requests with 'Authorization: Bearer METRICS_TOKEN'.
+    # Behind a front proxy every client comes from the proxy's address, use the token there. Requests (and edit jobs)
+    # slower than SLOW_REQUEST_SECONDS are logged with their phases, SLOW_REQUEST_THRESHOLDS overrides it
+    # per endpoint, for example {'views.modify_image': 5.0}
+    app.config['METRICS_BUCKETS'] = DEFAULT_BUCKETS
+    app.config['METRICS_ALLOWED_ADDRESSES'] = ()
+    app.config['METRICS_TOKEN'] = None
+    app.config['SLOW_REQUEST_SECONDS'] = 1.0
+    app.config['SLOW_REQUEST_THRESHOLDS'] = {}
+
+    # Configuring the user cache, logged in users are loaded from memory for up to USER_CACHE_TTL seconds
+    app.config['USER_CACHE_SIZE'] = 1024
+    app.config['USER_CACHE_TTL'] = 60
+
+    # Configuring the password hasher, at most this many password hashes are computed at once
+    app.config['PASSWORD_HASH_WORKERS'] = 2
+
+    # Configuring large images. Uploads above MAX_IMAGE_PIXELS are refused, which is also Pillow's
+    # decompression bomb limit. Images above LARGE_IMAGE_PIXELS are edited in tiles of
+    # LARGE_IMAGE_TILE_SIZE pixels, and edits whose estimated memory use is above
+    # IMAGE_MEMORY_BUDGET bytes are refused before they are queued
+    app.config['MAX_IMAGE_PIXELS'] = 100_000_000
+    app.config['LARGE_IMAGE_PIXELS'] = 24_000_000
+    app.config['LARGE_IMAGE_TILE_SIZE'] = 512
+    app.config['IMAGE_MEMORY_BUDGET'] = 1024 * 1024 * 1024
+
+    # Settings passed to create_app (for example by the benchmarks) override the defaults above
+    if config is not None:
+        app.config.update(config)
+
+    # Pillow's decompression bomb guard is process wide, render_variant checks the same limit in the workers
+    PILImage.MAX_IMAGE_PIXELS = app.config['MAX_IMAGE_PIXELS']
+
+    # Initializing the extensions
+    db.init_app(app)
+    thumbnail_cache.init_app(app)
+    job_queue.init_app(app)
+    variant_store.init_app(app)
+    metrics.init_app(app)
+    user_cache.init_app(app)
+    password_hasher.init_app(app)
+
     # Registering the blueprints
     from .views import views
     from .auth import auth
@@ -30,11 +134,32 @@ def create_app():
     app.register_blueprint(auth, url_prefix="/")
     
     # Import the models
-    from .models import User
+    from .models import User, EditHistory, Image, ImageHash
 
     # Create the database
     create_database(app)
 
+    # Sync the image catalog with the upload folder, `flask reconcile-images` does the same on demand
+    from .catalog import reconcile
+
+    if app.config['CATALOG_RECONCILE_ON_STARTUP']:
+        with app.app_context():
+            reconcile(app.config['UPLOAD_FOLDER'])
+
+    @app.cli.command('reconcile-images')
+    def reconcile_images():
+        added, updated, removed = reconcile(app.config['UPLOAD_FOLDER'])
+        print(f'Image catalog reconciled: {added} added, {updated} updated, {removed} removed')
+
+    # Perceptual hashes of catalog entries that have none yet, for example files found by the reconciler
+    from .similarity import backfill
+
+    @app.cli.command('hash-images')
+    @click.option('--workers', type=int, default=None, help='Worker processes, defaults to the number of CPUs.')
+    def hash_images(workers):
+        hashed, failed, removed = backfill(app.config['UPLOAD_FOLDER'], workers)
+        print(f'Image hashes backfilled: {hashed} hashed, {failed} unreadable, {removed} stale removed')
+
     # Configuring the login manager
     login_manager = LoginManager()
     login_manager.login_view = 'auth.login'
@@ -42,7 +167,7 @@ def create_app():
 
     @login_manager.user_loader
     def load_user(id):
-        return User.query.get(int(id))
+        return user_cache.get(db.session, User, int(id))
     
 
     return app
@@ -0,0 +1,195 @@
+from PIL import Image, ImageFilter
+import math
+import numpy as np
+
+# Weights Pillow converts RGB to L with, in 16.16 fixed point
+LUMINANCE_WEIGHTS = (19595, 38470, 7471)
+
+# Modes Pillow's box blur works on, other images are converted first
+BLUR_MODES = ('L', 'LA', 'RGB', 'RGBA', 'RGBX', 'CMYK')
+
+# Box blur passes Pillow approximates a Gaussian blur with
+GAUSSIAN_PASSES = 3
+
+IDENTITY = np.arange(256)
+
+
+def has_adjustments(plan):
+    # Whether plan changes the tone or colour of the image (blurs are applied on their own)
+    return bool(plan.levels or plan.brightness is not None or plan.contrast or plan.gamma
+                or plan.equalize or plan.saturation is not None)
+
+
+def adjust(image, plan, tile_size=None):
+    # Apply the tonal adjustments of plan in this order: levels, brightness, contrast, gamma, histogram
+    # equalization and saturation. All but saturation map every band value on its own, so they are folded
+    # into one lookup table per band: the image is read once for the histograms contrast and equalization
+    # need and mapped once, instead of once per ImageEnhance step. NumPy works on the 256 entry tables
+    # and histograms only, the passes over the pixels are Pillow's C loops.
+    # With a tile_size the work is done in strips of about tile_size x tile_size pixels written back into
+    # image in place, so no full-size copy is ever made
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    strips = _strips(image.size, tile_size * tile_size if tile_size else None)
+    table = lookup_tables(image, plan, strips).ravel().tolist()
+
+    if not tile_size:
+        return _map(image, table, plan.saturation)
+    for box in strips:
+        image.paste(_map(image.crop(box), table, plan.saturation), box)
+    return image
+
+
+def lookup_tables(image, plan, strips):
+    # Compose the per-band adjustments of plan into a (bands, 256) array of uint8 tables.
+    # Contrast and equalization depend on the image as the earlier adjustments left it, their
+    # statistics are worked out from the histogram of image pushed through the tables so far
+    tables = np.tile(IDENTITY, (3, 1))
+    histogram = None
+
+    if plan.levels:
+        tables = levels_table(*plan.levels)[tables]
+    if plan.brightness is not None:
+        tables = brightness_table(plan.brightness)[tables]
+    if plan.contrast:
+        if (tables == IDENTITY).all():
+            # Nothing changed the image yet, take the exact mean of its greyscale copy like ImageEnhance
+            mean = _luminance_mean(image, strips)
+        else:
+            histogram = _histogram(image, strips)
+            mean = _mapped_luminance_mean(histogram, tables)
+        tables = contrast_table(int(mean + 0.5), plan.contrast)[tables]
+    if plan.gamma:
+        tables = gamma_table(plan.gamma)[tables]
+    if plan.equalize:
+        if histogram is None:
+            histogram = _histogram(image, strips)
+        tables = np.stack([equalize_table(_mapped_histogram(histogram[band], tables[band]))[tables[band]]
+                           for band in range(3)])
+
+    return tables.astype(np.uint8)
+
+
+def levels_table(black, white):
+    # Stretch input values black..white to the full 0..255 range
+    return np.clip(np.rint((IDENTITY - black) * 255.0 / (white - black)), 0, 255).astype(np.int64)
+
+
+def brightness_table(factor):
+    # ImageEnhance.Brightness blends with a black image: v * factor, truncated
+    return _blend_table(0, factor)
+
+
+def contrast_table(mean, factor):
+    # ImageEnhance.Contrast blends with a flat grey of the mean luminance: mean + factor * (v - mean), truncated
+    return _blend_table(mean, factor)
+
+
+def gamma_table(gamma):
+    # Gamma correction, values above 1 brighten the midtones
+    return np.rint(255.0 * (IDENTITY / 255.0) ** (1.0 / gamma)).astype(np.int64)
+
+
+def equalize_table(histogram):
+    # The table ImageOps.equalize builds for one band from its histogram
+    used = histogram[histogram > 0]
+    if len(used) <= 1:
+        return IDENTITY
+    step = (int(used.sum()) - int(used[-1])) // 255
+    if not step:
+        return IDENTITY
+    below = np.concatenate(([0], np.cumsum(histogram)[:-1]))
+    return np.minimum((step // 2 + below) // step, 255)
+
+
+def blur(image, radius, mode='gaussian', tile_size=None):
+    # Gaussian or box blur with Pillow's extended box blur. With a tile_size every tile is blurred with
+    # enough of its surroundings that the result is the same as blurring the whole image
+    if image.mode not in BLUR_MODES:
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+
+    image_filter = ImageFilter.BoxBlur(radius) if mode == 'box' else ImageFilter.GaussianBlur(radius)
+    if not tile_size:
+        return image.filter(image_filter)
+
+    reach = blur_reach(radius, mode)
+    result = Image.new(image.mode, image.size)
+    for top in range(0, image.height, tile_size):
+        for left in range(0, image.width, tile_size):
+            right = min(left + tile_size, image.width)
+            bottom = min(top + tile_size, image.height)
+            box = (max(0, left - reach), max(0, top - reach),
+                   min(image.width, right + reach), min(image.height, bottom + reach))
+            tile = image.crop(box).filter(image_filter)
+            result.paste(tile.crop((left - box[0], top - box[1], right - box[0], bottom - box[1])), (left, top))
+    return result
+
+
+def gaussian_box_radius(radius, passes=GAUSSIAN_PASSES):
+    # Radius of the box blur passes Pillow approximates a Gaussian of radius (its standard deviation) with,
+    # see _gaussian_blur_radius in Pillow's BoxBlur.c
+    sigma2 = radius * radius / passes
+    length = math.sqrt(12.0 * sigma2 + 1.0)
+    whole = math.floor((length - 1.0) / 2.0)
+    fraction = (2 * whole + 1) * (whole * (whole + 1) - 3 * sigma2)
+    fraction /= 6 * (sigma2 - (whole + 1) * (whole + 1))
+    return whole + fraction
+
+
+def blur_reach(radius, mode='gaussian'):
+    # How far apart two pixels can be and still affect each other in a blur. Every box blur pass
+    # reads the whole pixels within its radius plus a weighted pixel on each side
+    if mode == 'box':
+        return int(radius) + 1
+    return GAUSSIAN_PASSES * (int(gaussian_box_radius(radius)) + 1)
+
+
+def _blend_table(base, factor):
+    # Image.blend computes base + factor * (v - base) in float32 and truncates
+    blended = np.float32(base) + np.float32(factor) * (IDENTITY - base).astype(np.float32)
+    return np.clip(blended, 0, 255).astype(np.int64)
+
+
+def _map(image, table, saturation):
+    # One lookup table pass, then the blend with the greyscale copy ImageEnhance.Color does for saturation
+    image = image.point(table)
+    if saturation is not None:
+        image = Image.blend(image.convert('L').convert('RGB'), image, saturation)
+    return image
+
+
+def _histogram(image, strips):
+    # (bands, 256) histogram of image, one read pass
+    histogram = np.zeros(768, np.int64)
+    for box in strips:
+        histogram += image.crop(box).histogram() if box else image.histogram()
+    return histogram.reshape(3, 256)
+
+
+def _luminance_mean(image, strips):
+    histogram = np.zeros(256, np.int64)
+    for box in strips:
+        histogram += (image.crop(box) if box else image).convert('L').histogram()
+    return (histogram * IDENTITY).sum() / histogram.sum()
+
+
+def _mapped_histogram(histogram, table):
+    # Histogram of a band after mapping it through table
+    return np.bincount(table, weights=histogram, minlength=256).astype(np.int64)
+
+
+def _mapped_luminance_mean(histogram, tables):
+    # Mean luminance of the image after mapping it through tables. Luminance is a weighted sum of the bands,
+    # so its mean follows from the band means; only Pillow's per pixel rounding is lost
+    pixels = histogram[0].sum()
+    means = [(histogram[band] * tables[band]).sum() / pixels for band in range(3)]
+    return sum(weight * mean for weight, mean in zip(LUMINANCE_WEIGHTS, means)) / 65536
+
+
+def _strips(size, pixels):
+    # Boxes of whole rows with about pixels pixels each, a single None (the whole image) without a limit
+    if pixels is None:
+        return [None]
+    rows = max(1, pixels // size[0])
+    return [(0, top, size[0], min(top + rows, size[1])) for top in range(0, size[1], rows)]
@@ -0,0 +1,52 @@
+import os
+import time
+import zipfile
+
+# Size of the pieces read from disk and handed to the client
+CHUNK_SIZE = 256 * 1024
+
+
+class _StreamBuffer:
+    # Write-only file object for ZipFile: it has no tell() or seek(), so zipfile writes entries with
+    # data descriptors and never goes back, and everything written can be drained and sent right away
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        # Everything written since the last drain, as a list of zero or one chunks
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return [data] if data else []
+
+
+def stream_zip(entries):
+    # Generate a ZIP archive of (archive name, file path or bytes) entries piece by piece while the
+    # entries iterable produces them. Images are already compressed, so entries are stored as is
+    buffer = _StreamBuffer()
+
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for name, source in entries:
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+
+            if isinstance(source, bytes):
+                archive.writestr(info, source)
+                yield from buffer.drain()
+                continue
+
+            info.file_size = os.path.getsize(source)
+            with open(source, 'rb') as file, archive.open(info, 'w') as member:
+                for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                    member.write(chunk)
+                    yield from buffer.drain()
+            yield from buffer.drain()
+
+    # Central directory
+    yield from buffer.drain()
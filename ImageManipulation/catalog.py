@@ -0,0 +1,104 @@
+from PIL import Image as PILImage
+from . import db
+from .models import Image
+from .storage import file_hash
+import os
+
+# Extensions of the files that belong in the catalog
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# Columns listings can be sorted by
+SORT_COLUMNS = {
+    'name': Image.filename,
+    'date': Image.mtime,
+    'size': Image.byte_size,
+}
+
+
+def add_image(upload_folder, filename, owner_id=None, content_hash=None):
+    # Insert or refresh the catalog entry of filename, reading only its header
+    image = Image.query.filter_by(filename=filename).first()
+    if image is None:
+        image = Image(filename=filename, owner_id=owner_id)
+        db.session.add(image)
+
+    _update(image, _read_metadata(os.path.join(upload_folder, filename), content_hash))
+    db.session.commit()
+    return image
+
+
+def remove_image(filename):
+    Image.query.filter_by(filename=filename).delete()
+    db.session.commit()
+
+
+def reconcile(upload_folder):
+    # Bring the catalog in line with the upload folder with one directory scan. Files whose size and
+    # mtime still match their entry are not opened. Returns (added, updated, removed) counts
+    known = {
+        filename: (mtime, byte_size)
+        for filename, mtime, byte_size in db.session.query(Image.filename, Image.mtime, Image.byte_size)
+    }
+
+    added = updated = 0
+    seen = set()
+    if os.path.isdir(upload_folder):
+        for entry in os.scandir(upload_folder):
+            if not entry.is_file() or not entry.name.endswith(IMAGE_EXTENSIONS):
+                continue
+            seen.add(entry.name)
+
+            stat = entry.stat()
+            if known.get(entry.name) == (stat.st_mtime, stat.st_size):
+                continue
+
+            image = Image.query.filter_by(filename=entry.name).first()
+            try:
+                metadata = _read_metadata(entry.path)
+            except (OSError, PILImage.DecompressionBombError):
+                # Not a readable image, keep it out of the catalog
+                if image is not None:
+                    db.session.delete(image)
+                continue
+
+            if image is None:
+                image = Image(filename=entry.name)
+                db.session.add(image)
+                added += 1
+            else:
+                updated += 1
+            _update(image, metadata)
+
+    missing = [filename for filename in known if filename not in seen]
+    for start in range(0, len(missing), 500):
+        Image.query.filter(Image.filename.in_(missing[start:start + 500])).delete(synchronize_session=False)
+
+    db.session.commit()
+    return added, updated, len(missing)
+
+
+def list_page(page=1, per_page=20, sort='name', order='asc'):
+    # One page of the catalog, sorted on an indexed column
+    column = SORT_COLUMNS.get(sort, Image.filename)
+    ordering = column.desc() if order == 'desc' else column.asc()
+    return Image.query.order_by(ordering, Image.id).paginate(page=page, per_page=per_page, error_out=False)
+
+
+def _read_metadata(file_path, content_hash=None):
+    stat = os.stat(file_path)
+    with PILImage.open(file_path) as opened:
+        image_format = opened.format
+        width, height = opened.size
+    return {
+        'format': image_format,
+        'width': width,
+        'height': height,
+        'byte_size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'content_hash': content_hash or file_hash(file_path),
+    }
+
+
+def _update(image, metadata):
+    for name, value in metadata.items():
+        setattr(image, name, value)
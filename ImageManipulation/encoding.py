@@ -0,0 +1,83 @@
+from PIL import features
+import io
+import os
+import threading
+
+# Encoder settings per preset and format: speed encodes fast, size spends encoder time on smaller files
+PRESETS = {
+    'speed': {
+        'JPEG': {'quality': 85},
+        'PNG': {'compress_level': 1},
+        'WEBP': {'quality': 80, 'method': 0},
+    },
+    'balanced': {
+        'JPEG': {'quality': 85, 'optimize': True, 'progressive': True},
+        'PNG': {'compress_level': 6},
+        'WEBP': {'quality': 80, 'method': 4},
+    },
+    'size': {
+        'JPEG': {'quality': 80, 'optimize': True, 'progressive': True},
+        'PNG': {'optimize': True},
+        'WEBP': {'quality': 75, 'method': 6},
+    },
+}
+
+# File extension of every format images are encoded to
+EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp'}
+
+# Modes each format can store, anything else is converted first
+FORMAT_MODES = {
+    'JPEG': ('1', 'L', 'RGB', 'CMYK'),
+    'PNG': ('1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'I', 'I;16'),
+    'WEBP': ('RGB', 'RGBA'),
+}
+
+
+def save_options(image_format, preset):
+    # Keyword arguments for Image.save, formats the preset doesn't mention are saved with Pillow's defaults
+    if preset not in PRESETS:
+        raise ValueError(f'Unknown encoding preset {preset!r}, choose from {", ".join(PRESETS)}')
+    return dict(PRESETS[preset].get(image_format, {}))
+
+
+def encode(image, path, image_format, preset):
+    # Save image to path in image_format with the preset's encoder settings.
+    # The file is written to a temporary name first so concurrent readers never see a partial file
+    image = convertible(image, image_format)
+    temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    image.save(temporary_path, format=image_format, **save_options(image_format, preset))
+    os.replace(temporary_path, path)
+    return path
+
+
+def encode_bytes(image, image_format, preset):
+    # image encoded in memory, for responses that are never stored
+    output = io.BytesIO()
+    convertible(image, image_format).save(output, format=image_format, **save_options(image_format, preset))
+    return output.getvalue()
+
+
+def convertible(image, image_format):
+    # image in a mode image_format can store, keeping transparency where the format has an alpha channel
+    modes = FORMAT_MODES.get(image_format)
+    if modes is None or image.mode in modes:
+        return image
+
+    transparent = 'A' in image.getbands() or 'transparency' in image.info
+    if transparent and 'RGBA' in modes:
+        return image.convert('RGBA')
+    return image.convert('RGB')
+
+
+def webp_supported():
+    # Pillow can be built without libwebp
+    return features.check('webp')
+
+
+def negotiate_format(accept_mimetypes, image_format):
+    # Format to send an image stored as image_format in: WebP when the client lists it explicitly
+    # (a bare */* is not enough, older clients send it too) and Pillow can encode it
+    for mimetype, quality in accept_mimetypes:
+        if mimetype == 'image/webp' and quality > 0 and webp_supported():
+            return 'WEBP'
+    return image_format
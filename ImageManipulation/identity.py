@@ -0,0 +1,150 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from werkzeug.security import generate_password_hash, check_password_hash
+import threading
+import time
+
+
+class UserCache:
+    # Column values of recently loaded users, so authenticated requests don't query the user table.
+    # Bounded in entries, each one expires after a TTL and is dropped as soon as its row changes
+
+    def __init__(self, app=None):
+        self.max_entries = 0
+        self.ttl = 0
+        # Maps user id -> (expires at, column values), least recently used first
+        self._entries = OrderedDict()
+        # Maps user id -> number of times its row changed, a row loaded while it changed is not cached
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_entries = app.config['USER_CACHE_SIZE']
+        self.ttl = app.config['USER_CACHE_TTL']
+        app.extensions['user_cache'] = self
+
+        with self._lock:
+            self._entries.clear()
+
+    def get(self, session, model, user_id):
+        # Return the user with user_id attached to session, only querying the database on a miss
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                values = entry[1]
+            else:
+                self._entries.pop(user_id, None)
+                self.misses += 1
+                values = None
+                generation = self._generations.get(user_id, 0)
+
+        if values is not None:
+            # Rebuild the row as a detached instance and attach it without a SELECT
+            user = model(**values)
+            make_transient_to_detached(user)
+            return session.merge(user, load=False)
+
+        user = session.get(model, user_id)
+        if user is not None and self.max_entries:
+            values = {column.key: getattr(user, column.key) for column in inspect(model).column_attrs}
+            with self._lock:
+                # The row is read outside the lock, an update committed meanwhile may have been read or not
+                if self._generations.get(user_id, 0) == generation:
+                    self._entries[user_id] = (now + self.ttl, values)
+                    self._entries.move_to_end(user_id)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id):
+        # Called whenever a user row is updated or deleted. Other processes keep their copy until the TTL runs out
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations,
+                    'entries': len(self._entries)}
+
+
+class PasswordHasher:
+    # Small dedicated thread pool for the deliberately slow password hashes. The request still waits
+    # for its result, but a burst of logins can only keep this many hashes running at once and the
+    # remaining request threads stay free for image requests
+
+    def __init__(self, app=None):
+        self.max_workers = 2
+        self._executor = None
+        self._lock = threading.Lock()
+        self.hashed = 0
+        self.verified = 0
+        self.pending = 0
+        self.queue_seconds = 0.0
+        self.run_seconds = 0.0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_workers = app.config['PASSWORD_HASH_WORKERS']
+        app.extensions['password_hasher'] = self
+
+    def hash(self, password):
+        with self._lock:
+            self.hashed += 1
+        return self._run(generate_password_hash, password)
+
+    def verify(self, password_hash, password):
+        with self._lock:
+            self.verified += 1
+        return self._run(check_password_hash, password_hash, password)
+
+    def stats(self):
+        with self._lock:
+            return {'hashed': self.hashed, 'verified': self.verified, 'pending': self.pending,
+                    'queue_seconds': self.queue_seconds, 'run_seconds': self.run_seconds}
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _run(self, function, *args):
+        submitted_at = time.perf_counter()
+        with self._lock:
+            self.pending += 1
+            executor = self._get_executor()
+        try:
+            return executor.submit(self._timed, function, args, submitted_at).result()
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def _timed(self, function, args, submitted_at):
+        started_at = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            with self._lock:
+                self.queue_seconds += started_at - submitted_at
+                self.run_seconds += time.perf_counter() - started_at
+
+    def _get_executor(self):
+        # Started on first use, like the job queue's process pool
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='password-hash')
+        return self._executor
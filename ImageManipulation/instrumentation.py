@@ -0,0 +1,215 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import g, request
+import bisect
+import threading
+import time
+
+# Default upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Recorder of the request or job currently running in this thread, None outside of one
+_recorder = ContextVar('recorder', default=None)
+
+
+class Recorder:
+    # Phase durations and bytes read and written by one request or one job
+
+    def __init__(self):
+        self.phases = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def to_dict(self):
+        return {
+            'phases': {name: round(seconds, 6) for name, seconds in self.phases.items()},
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+        }
+
+
+@contextmanager
+def recording():
+    # Collect the phases of everything run inside the block, also used in the job worker processes
+    recorder = Recorder()
+    token = _recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorder.reset(token)
+
+
+@contextmanager
+def phase(name):
+    # Add the time spent in the block to phase name, does nothing when nothing is being recorded
+    recorder = _recorder.get()
+    if recorder is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.phases[name] = recorder.phases.get(name, 0.0) + time.perf_counter() - started
+
+
+def count_read(size):
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.bytes_read += size
+
+
+def count_written(size):
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.bytes_written += size
+
+
+class Histogram:
+    # Cumulative Prometheus histogram per set of label values
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # Maps label values -> [bucket counts..., count, sum]
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.setdefault(labels, [0] * len(self.buckets) + [0, 0.0])
+        # Values above the last bound only count towards +Inf, which is the total count
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += 1
+        series[-1] += value
+
+
+class Metrics:
+    # Request latency, per-phase timings and byte counters, exposed in the Prometheus text format
+
+    def __init__(self, app=None):
+        self.slow_seconds = None
+        self.slow_thresholds = {}
+        self.logger = None
+        self._histograms = {}
+        self._counters = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.slow_seconds = app.config['SLOW_REQUEST_SECONDS']
+        self.slow_thresholds = dict(app.config['SLOW_REQUEST_THRESHOLDS'])
+        self.logger = app.logger
+        buckets = app.config['METRICS_BUCKETS']
+        app.extensions['metrics'] = self
+
+        with self._lock:
+            self._histograms = {
+                'image_request_duration_seconds': Histogram(buckets),
+                'image_phase_duration_seconds': Histogram(buckets),
+            }
+            self._counters = {
+                'image_bytes_read_total': {},
+                'image_bytes_written_total': {},
+                'image_slow_requests_total': {},
+            }
+        self._help = {
+            'image_request_duration_seconds': 'Time to build the response of a request, by endpoint, method and status',
+            'image_phase_duration_seconds': 'Time spent in one phase of a request or edit job, by endpoint and phase',
+            'image_bytes_read_total': 'Image bytes read from disk, by endpoint',
+            'image_bytes_written_total': 'Image bytes written to disk, by endpoint',
+            'image_slow_requests_total': 'Requests and edit jobs slower than their threshold, by endpoint',
+        }
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._clear_request)
+
+    def observe(self, endpoint, recorder, seconds, method=None, status=None):
+        # Record one finished request (method and status given) or edit job and log it when it was slow
+        with self._lock:
+            if method is not None:
+                self._histograms['image_request_duration_seconds'].observe((endpoint, method, str(status)), seconds)
+            for name, phase_seconds in recorder.phases.items():
+                self._histograms['image_phase_duration_seconds'].observe((endpoint, name), phase_seconds)
+            if recorder.bytes_read:
+                self._add('image_bytes_read_total', endpoint, recorder.bytes_read)
+            if recorder.bytes_written:
+                self._add('image_bytes_written_total', endpoint, recorder.bytes_written)
+
+        threshold = self.slow_thresholds.get(endpoint, self.slow_seconds)
+        if threshold is not None and seconds > threshold:
+            with self._lock:
+                self._add('image_slow_requests_total', endpoint, 1)
+            phases = ', '.join(f'{name}={phase_seconds * 1000:.1f}ms' for name, phase_seconds in recorder.phases.items())
+            self.logger.warning('Slow %s %s took %.1fms (threshold %.1fms): %s, read %d bytes, wrote %d bytes',
+                                method or 'job', endpoint, seconds * 1000, threshold * 1000, phases or 'no phases',
+                                recorder.bytes_read, recorder.bytes_written)
+
+    def observe_job(self, endpoint, job):
+        # Record the phases an edit job measured in its worker process
+        recorder = Recorder()
+        recorder.phases = job['phases']
+        recorder.bytes_read = job['bytes_read']
+        recorder.bytes_written = job['bytes_written']
+        self.observe(endpoint, recorder, job['run_seconds'])
+
+    def render(self, extra=()):
+        # Every metric in the Prometheus text exposition format, extra are (name, type, help, value)
+        # samples owned by other parts of the app
+        lines = []
+        with self._lock:
+            for name, histogram in self._histograms.items():
+                label_names = ('endpoint', 'method', 'status') if name == 'image_request_duration_seconds' else ('endpoint', 'phase')
+                lines += [f'# HELP {name} {self._help[name]}', f'# TYPE {name} histogram']
+                for labels, series in sorted(histogram.series.items()):
+                    base = dict(zip(label_names, labels))
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, series):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{_labels(base, le=f"{bound:g}")} {cumulative}')
+                    lines.append(f'{name}_bucket{_labels(base, le="+Inf")} {series[-2]}')
+                    lines.append(f'{name}_count{_labels(base)} {series[-2]}')
+                    lines.append(f'{name}_sum{_labels(base)} {series[-1]:.6f}')
+
+            for name, values in self._counters.items():
+                lines += [f'# HELP {name} {self._help[name]}', f'# TYPE {name} counter']
+                for endpoint, value in sorted(values.items()):
+                    lines.append(f'{name}{_labels({"endpoint": endpoint})} {value}')
+
+        for name, metric_type, help_text, value in extra:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, name, endpoint, value):
+        counter = self._counters[name]
+        counter[endpoint] = counter.get(endpoint, 0) + value
+
+    def _start_request(self):
+        g.metrics_started = time.perf_counter()
+        g.metrics_recorder = Recorder()
+        g.metrics_token = _recorder.set(g.metrics_recorder)
+
+    def _finish_request(self, response):
+        # Streamed bodies (downloads, ZIP archives) are sent after this, only building the response is timed
+        seconds = time.perf_counter() - g.metrics_started
+        self.observe(request.endpoint or 'unknown', g.metrics_recorder, seconds,
+                     method=request.method, status=response.status_code)
+        return response
+
+    def _clear_request(self, error=None):
+        token = g.pop('metrics_token', None)
+        if token is not None:
+            _recorder.reset(token)
+
+
+def _labels(labels, **extra):
+    labels = {**labels, **extra}
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,223 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from .instrumentation import recording
+import collections
+import queue
+import threading
+import time
+import uuid
+
+
+class QueueFull(Exception):
+    pass
+
+
+def _run_timed(function, args):
+    # Runs inside a worker process, so the job record can tell queue time and run time apart
+    # and show where the run time went
+    started_at = time.time()
+    with recording() as recorder:
+        result = function(*args)
+    return started_at, time.time(), recorder.to_dict(), result
+
+
+class JobQueue:
+    # Bounded pool of worker processes for image work, with an in-memory record of every job
+
+    def __init__(self, app=None):
+        self.max_workers = None
+        self.max_pending = 0
+        self.history_limit = 0
+        self._executor = None
+        self._jobs = OrderedDict()
+        self._futures = {}
+        self._pending = 0
+        # Reentrant, a future that is already done runs its callbacks right away in the thread adding them
+        self._lock = threading.RLock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_workers = app.config['JOB_WORKERS']
+        self.max_pending = app.config['JOB_QUEUE_LIMIT']
+        self.history_limit = app.config['JOB_HISTORY_LIMIT']
+        app.extensions['job_queue'] = self
+
+    def submit(self, function, *args, on_done=None, on_error=None):
+        # Queue function(*args) on the pool and return its job record right away,
+        # raises QueueFull when too many jobs are already waiting. on_done(job, result)
+        # is called with the finished job record once the function has returned,
+        # on_error(job, error) with the failed one when it raised or its worker died
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise QueueFull(f'{self._pending} jobs are already waiting')
+
+            job = {
+                'id': uuid.uuid4().hex,
+                'status': 'queued',
+                'error': None,
+                'submitted_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+                'queue_seconds': None,
+                'run_seconds': None,
+                'phases': None,
+                'bytes_read': None,
+                'bytes_written': None,
+            }
+            future = self._submit(_run_timed, function, args)
+
+            self._jobs[job['id']] = job
+            self._futures[job['id']] = future
+            self._pending += 1
+            self._trim_history()
+
+        future.add_done_callback(lambda future: self._finish(job, future, on_done, on_error))
+        return dict(job)
+
+    def run(self, function, *args, timeout=None):
+        # Run function(*args) on the pool and wait for its result, for work a response needs that is too heavy
+        # for the web process. Raises QueueFull, TimeoutError when it is not done after timeout seconds (the
+        # job keeps running) or the error function raised
+        finished = threading.Event()
+        outcome = {}
+
+        def done(job, result):
+            outcome['result'] = result
+            finished.set()
+
+        def failed(job, error):
+            outcome['error'] = error
+            finished.set()
+
+        self.submit(function, *args, on_done=done, on_error=failed)
+        if not finished.wait(timeout):
+            raise TimeoutError(f'{function.__name__} did not finish within {timeout} seconds')
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['result']
+
+    def map_unordered(self, function, argument_lists):
+        # Run function(*arguments) for every entry of argument_lists on the pool and return a generator
+        # of (index, result, error) in completion order. Used for batches, the work counts towards the
+        # queue limit but is not recorded as individual jobs. A batch takes the slots that are free when
+        # it starts, raises QueueFull when there are none, and every entry that finishes hands its slot
+        # to the next one, so the queue never holds more than max_pending and large batches still run
+        batch = {'entries': collections.deque(enumerate(argument_lists)), 'futures': set(), 'closed': False}
+        finished = queue.Queue()
+        total = len(batch['entries'])
+
+        def submit_next():
+            # Called with the lock held, hands a slot that is already counted to the next entry. Entries that
+            # can't be submitted (the pool broke again or is shut down) are reported as failed and pass the slot on
+            while batch['entries'] and not batch['closed']:
+                index, arguments = batch['entries'].popleft()
+                try:
+                    future = self._submit(function, *arguments)
+                except RuntimeError as error:
+                    failed = Future()
+                    failed.set_exception(error)
+                    finished.put((index, failed))
+                    continue
+                batch['futures'].add(future)
+                future.add_done_callback(lambda future: done(index, future))
+                return
+            self._pending -= 1
+
+        def done(index, future):
+            with self._lock:
+                batch['futures'].discard(future)
+                submit_next()
+            finished.put((index, future))
+
+        with self._lock:
+            window = min(total, self.max_pending - self._pending)
+            if total and window <= 0:
+                raise QueueFull(f'{self._pending} jobs are already waiting')
+            self._pending += window
+            for _ in range(window):
+                submit_next()
+
+        return self._iterate_completed(batch, finished, total)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+
+            job = dict(job)
+            future = self._futures.get(job_id)
+            if job['status'] == 'queued' and future is not None and future.running():
+                job['status'] = 'running'
+            return job
+
+    def pending(self):
+        with self._lock:
+            return self._pending
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _finish(self, job, future, on_done, on_error):
+        with self._lock:
+            self._pending -= 1
+            self._futures.pop(job['id'], None)
+            error = future.exception()
+            if error is None:
+                job['started_at'], job['finished_at'], recorded, result = future.result()
+                job.update(recorded)
+                job['status'] = 'finished'
+                job['queue_seconds'] = job['started_at'] - job['submitted_at']
+                job['run_seconds'] = job['finished_at'] - job['started_at']
+            else:
+                job['status'] = 'failed'
+                job['error'] = str(error) or error.__class__.__name__
+                job['finished_at'] = time.time()
+
+        if on_done is not None and error is None:
+            on_done(dict(job), result)
+        if on_error is not None and error is not None:
+            on_error(dict(job), error)
+
+    def _iterate_completed(self, batch, finished, total):
+        try:
+            for _ in range(total):
+                index, future = finished.get()
+                error = future.exception()
+                result = future.result() if error is None else None
+                yield index, result, error
+        finally:
+            # The client went away, don't render what nobody will receive
+            with self._lock:
+                batch['closed'] = True
+                futures = list(batch['futures'])
+            for future in futures:
+                future.cancel()
+
+    def _submit(self, function, *args):
+        # Called with the lock held
+        try:
+            return self._get_executor().submit(function, *args)
+        except BrokenProcessPool:
+            # A worker died (for example killed for running out of memory), start a fresh pool
+            self._executor = None
+            return self._get_executor().submit(function, *args)
+
+    def _trim_history(self):
+        # Forget the oldest finished jobs once the record grows past its limit
+        while len(self._jobs) > self.history_limit:
+            oldest_id = next(iter(self._jobs))
+            if self._jobs[oldest_id]['status'] == 'queued':
+                break
+            del self._jobs[oldest_id]
+
+    def _get_executor(self):
+        # The pool is started on first use so importing the app never forks workers
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
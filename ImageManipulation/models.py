@@ -1,7 +1,7 @@
-from . import db
+from . import db, user_cache, password_hasher
 from flask_login import UserMixin
+from sqlalchemy import event
 from sqlalchemy.sql import func
-from werkzeug.security import generate_password_hash, check_password_hash
 
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
@@ -10,11 +10,68 @@ class User(db.Model, UserMixin):
     password_hash = db.Column(db.String(128))
     date_created = db.Column(db.DateTime(timezone=True), default=func.now())
 
+    # Hashing runs on the password hasher's own threads, see PASSWORD_HASH_WORKERS
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
     
     def __repr__(self):
-        return f'<User {self.username}>'
\ No newline at end of file
+        return f'<User {self.username}>'
+
+
+# Cached copies of a user must not outlive a change to its row
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def forget_cached_user(mapper, connection, target):
+    user_cache.invalidate(target.id)
+
+
+class EditHistory(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(255), index=True, unique=True)
+    # Ordered list of normalized edit steps, see TransformPlan.to_dict
+    operations = db.Column(db.JSON, default=list)
+    # Number of steps currently applied, undo and redo only move this
+    position = db.Column(db.Integer, default=0)
+    date_modified = db.Column(db.DateTime(timezone=True), default=func.now(), onupdate=func.now())
+
+    def applied_operations(self):
+        return self.operations[:self.position]
+
+    def __repr__(self):
+        return f'<EditHistory {self.filename} {self.position}/{len(self.operations)}>'
+
+
+class Image(db.Model):
+    # Catalog of the files in the upload folder, kept in sync by catalog.reconcile
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(255), index=True, unique=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    format = db.Column(db.String(16))
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    byte_size = db.Column(db.Integer, index=True)
+    mtime = db.Column(db.Float, index=True)
+    content_hash = db.Column(db.String(64), index=True)
+    date_created = db.Column(db.DateTime(timezone=True), default=func.now())
+
+    def __repr__(self):
+        return f'<Image {self.filename}>'
+
+
+class ImageHash(db.Model):
+    # Perceptual hash (dHash) of uploaded content, keyed by the content's SHA-256 like the blob store so
+    # files sharing their bytes share it. The 64 bits are also stored as four indexed 16 bit bands for
+    # near-duplicate lookups, see similarity.similar_hashes
+    content_hash = db.Column(db.String(64), primary_key=True)
+    dhash = db.Column(db.String(16))
+    band0 = db.Column(db.Integer, index=True)
+    band1 = db.Column(db.Integer, index=True)
+    band2 = db.Column(db.Integer, index=True)
+    band3 = db.Column(db.Integer, index=True)
+    date_created = db.Column(db.DateTime(timezone=True), default=func.now())
+
+    def __repr__(self):
+        return f'<ImageHash {self.dhash}>'
@@ -0,0 +1,400 @@
+from PIL import Image
+from .adjustments import adjust, blur, blur_reach, has_adjustments, BLUR_MODES
+from .instrumentation import phase, count_read
+import copy
+import math
+import os
+
+# Formats whose decoder can hand back a reduced-size image directly
+DRAFT_FORMATS = ('JPEG',)
+
+# Downscales by at least this factor first shrink by whole factors with reduce(), the same
+# trade-off Image.resize makes with reducing_gap
+REDUCING_GAP = 2.0
+
+# Bytes per pixel of Pillow's in-memory modes, RGB and the other multi-band modes are padded to four
+MODE_BYTES = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2, 'I;16B': 2, 'I;16L': 2}
+
+
+class MemoryBudgetExceeded(Exception):
+    pass
+
+
+class RenderPolicy:
+    # Memory limits and encoder preset of a render, built from the app config and handed to the worker
+    # processes with each job. Images above large_image_pixels are processed in tiles of tile_size x tile_size
+    # pixels, the result is saved with the encoding preset (see encoding.PRESETS)
+
+    def __init__(self, max_pixels=None, large_image_pixels=None, memory_budget=None, tile_size=512, preset='balanced'):
+        self.max_pixels = max_pixels
+        self.large_image_pixels = large_image_pixels
+        self.memory_budget = memory_budget
+        self.tile_size = tile_size
+        self.preset = preset
+
+    def __repr__(self):
+        return (f'<RenderPolicy max_pixels={self.max_pixels} large_image_pixels={self.large_image_pixels} '
+                f'memory_budget={self.memory_budget} tile_size={self.tile_size} preset={self.preset}>')
+
+    def tile_size_for(self, size):
+        # Tile size to process an image of size with, None when it is small enough to process whole
+        if self.large_image_pixels is not None and size[0] * size[1] > self.large_image_pixels:
+            return self.tile_size
+        return None
+
+
+class TransformPlan:
+    # The requested manipulations of one modify request, compiled before the image is touched.
+    # levels is a (black, white) pair of input values, blur_mode is 'gaussian' or 'box'
+
+    def __init__(self, size=None, rotate=0, contrast=None, brightness=None, saturation=None, gamma=None,
+                 levels=None, equalize=False, blur=None, blur_mode='gaussian'):
+        self.size = size
+        self.rotate = rotate % 360
+        self.contrast = contrast
+        self.brightness = brightness
+        self.saturation = saturation
+        self.gamma = gamma
+        self.levels = levels
+        self.equalize = equalize
+        self.blur = blur
+        self.blur_mode = blur_mode
+
+    def __repr__(self):
+        return (f'<TransformPlan size={self.size} rotate={self.rotate} contrast={self.contrast} '
+                f'brightness={self.brightness} saturation={self.saturation} gamma={self.gamma} '
+                f'levels={self.levels} equalize={self.equalize} blur={self.blur} blur_mode={self.blur_mode}>')
+
+    def to_dict(self):
+        # Normalized form used to store edit steps and to build variant cache keys,
+        # only manipulations that change the image are present
+        step = {}
+        if self.size:
+            step['resize'] = list(self.size)
+        if self.rotate:
+            step['rotate'] = self.rotate
+        if self.contrast and self.contrast != 1.0:
+            step['contrast'] = round(self.contrast, 4)
+        if self.brightness is not None and self.brightness != 1.0:
+            step['brightness'] = round(self.brightness, 4)
+        if self.saturation is not None and self.saturation != 1.0:
+            step['saturation'] = round(self.saturation, 4)
+        if self.gamma and self.gamma != 1.0:
+            step['gamma'] = round(self.gamma, 4)
+        if self.levels and tuple(self.levels) != (0, 255):
+            step['levels'] = list(self.levels)
+        if self.equalize:
+            step['equalize'] = True
+        if self.blur:
+            step['blur'] = round(self.blur, 4)
+            step['blur_mode'] = self.blur_mode
+        return step
+
+    @classmethod
+    def from_dict(cls, step):
+        size = tuple(step['resize']) if 'resize' in step else None
+        levels = tuple(step['levels']) if 'levels' in step else None
+        return cls(size=size, rotate=step.get('rotate', 0), contrast=step.get('contrast'),
+                   brightness=step.get('brightness'), saturation=step.get('saturation'), gamma=step.get('gamma'),
+                   levels=levels, equalize=step.get('equalize', False), blur=step.get('blur'),
+                   blur_mode=step.get('blur_mode', 'gaussian'))
+
+    def scaled(self, scale):
+        # The same manipulations rendering the result at scale times its size, the target size and the blur
+        # radius (applied to the result) shrink with it so it looks like the full render at that scale
+        plan = copy.copy(self)
+        if self.size:
+            plan.size = (max(1, round(self.size[0] * scale)), max(1, round(self.size[1] * scale)))
+        if self.blur:
+            plan.blur = self.blur * scale
+        return plan
+
+
+def build_plan(width=None, height=None, rotate=None, contrast=None, brightness=None, saturation=None, gamma=None,
+               levels=None, equalize=False, blur=None, blur_mode='gaussian'):
+    # Turn validated form values into a plan, dropping manipulations that would not change anything
+    size = (width, height) if width and height else None
+    plan = TransformPlan(size=size, rotate=rotate or 0, contrast=contrast or None, equalize=bool(equalize),
+                         blur=blur or None, blur_mode=blur_mode or 'gaussian')
+    # Factors of 1 and the full levels range leave the image as it is
+    if brightness is not None and brightness != 1.0:
+        plan.brightness = brightness
+    if saturation is not None and saturation != 1.0:
+        plan.saturation = saturation
+    if gamma and gamma != 1.0:
+        plan.gamma = gamma
+    if levels and tuple(levels) != (0, 255):
+        plan.levels = tuple(levels)
+    return plan
+
+
+def render(file_path, plan, policy=None):
+    # Open file_path and apply plan with a single resample, a single adjustment pass and the blur.
+    # With a policy large images are processed in tiles, see check_memory for its limits
+    with Image.open(file_path) as image:
+        # A downscaled JPEG can be decoded straight at 1/2, 1/4 or 1/8 scale
+        if plan.size and image.format in DRAFT_FORMATS:
+            if plan.size[0] < image.width and plan.size[1] < image.height:
+                image.draft(None, plan.size)
+
+        # Decode up front so the decode is timed apart from the manipulations. Pillow has no
+        # streaming decoder, so the (possibly reduced) source is always held in memory whole
+        with phase('decode'):
+            image.load()
+        count_read(os.path.getsize(file_path))
+
+        tile_size = policy.tile_size_for(image.size) if policy is not None else None
+        image = apply_plan(image, plan, tile_size)
+
+        # Make sure nothing still depends on the source file once it is closed
+        image.load()
+        return image
+
+
+def render_preview(proxy_path, plans, full_size):
+    # Apply plans one after another to proxy_path, a downscaled copy of an image of full_size, for a quick look
+    # at edits before they are rendered. The preview is the full render scaled to fit the proxy's longest side
+    # (or the full render itself when that is smaller). Proxies are small enough to never need tiles
+    with Image.open(proxy_path) as image:
+        with phase('decode'):
+            image.load()
+        count_read(os.path.getsize(proxy_path))
+
+        target = next((plan.size for plan in reversed(plans) if plan.size), full_size)
+        scale = min(1.0, max(image.size) / max(target))
+        for plan in plans:
+            # Resizes render at the preview scale, other steps keep the size the image has at that point
+            # and only their blur radius follows it
+            step_scale = scale if plan.size else max(image.size) / max(full_size)
+            full_size = plan.size or full_size
+            image = apply_plan(image, plan.scaled(step_scale))
+        image.load()
+        return image
+
+
+def apply_plan(image, plan, tile_size=None):
+    # Apply plan to an already opened image. A resize with a rotation is one resample and is timed as rotate,
+    # the tonal adjustments are one pass of the adjustment engine (see adjustments.adjust) and the blur comes last.
+    # With a tile_size the work is done in tiles and strips of about tile_size x tile_size pixels, so
+    # only the source and the result are ever held whole. Adjustments are then applied to image in place
+    if plan.size or plan.rotate:
+        with phase('rotate' if plan.rotate else 'resize'):
+            image = _apply_geometry(image, plan.size or image.size, plan.rotate, tile_size)
+
+    if has_adjustments(plan):
+        with phase('adjust'):
+            image = adjust(image, plan, tile_size)
+
+    if plan.blur:
+        with phase('blur'):
+            image = blur(image, plan.blur, plan.blur_mode, tile_size)
+
+    return image
+
+
+def estimate_memory(image, plans, policy):
+    # Peak bytes of pixel data held while rendering plans on the opened (not yet decoded) image,
+    # worked out from its header. Counts the buffers of every step that are alive at the same time
+    size, mode = image.size, image.mode
+    first = plans[0]
+    if first.size and image.format in DRAFT_FORMATS:
+        size = _draft_size(size, first.size)
+
+    live = _image_bytes(size, mode)
+    peak = live
+    for plan in plans:
+        tile_size = policy.tile_size_for(size)
+        tile_bytes = _image_bytes((tile_size, tile_size), mode) if tile_size else 0
+
+        # The input of a plan stays referenced until the whole plan is applied, live counts what the plan adds
+        pinned, live = live, 0
+
+        if plan.size or plan.rotate:
+            target = plan.size or size
+            if target != size and mode in ('P', '1'):
+                expanded = _expanded_mode(mode, image.info)
+                converted = _image_bytes(size, expanded)
+                peak = max(peak, pinned + converted)
+                live, mode = converted, expanded
+
+            factor_x = int(size[0] / target[0] / REDUCING_GAP) or 1
+            factor_y = int(size[1] / target[1] / REDUCING_GAP) or 1
+            if factor_x > 1 or factor_y > 1:
+                reduced = _image_bytes((-(-size[0] // factor_x), -(-size[1] // factor_y)), mode)
+                peak = max(peak, pinned + live + reduced)
+                live = reduced
+
+            # Tiled rotations also hold the source crop of one tile and its transformed copy
+            result = _image_bytes(target, mode)
+            peak = max(peak, pinned + live + result + 6 * tile_bytes)
+            live, size = result, target
+
+        if has_adjustments(plan):
+            if mode != 'RGB':
+                converted = _image_bytes(size, 'RGB')
+                peak = max(peak, pinned + live + converted)
+                live, mode = converted, 'RGB'
+
+            current = live or pinned
+            # Saturation blends the mapped copy with a greyscale copy into a third one
+            copies = 3 if plan.saturation is not None else 1
+            if tile_size:
+                # One strip, its greyscale copy and its mapped copies
+                peak = max(peak, pinned + live + (2 + copies) * tile_bytes)
+            else:
+                # A greyscale copy for the mean, released before the mapped copies are made
+                peak = max(peak, pinned + live + max(_image_bytes(size, 'L'), copies * current))
+            live = current
+
+        if plan.blur:
+            if mode not in BLUR_MODES:
+                converted = _image_bytes(size, 'RGB')
+                peak = max(peak, pinned + live + converted)
+                live, mode = converted, 'RGB'
+
+            result = _image_bytes(size, mode)
+            if tile_size:
+                # A tile with its margin, blurred, and the part of it that is kept
+                margin = 2 * blur_reach(plan.blur, plan.blur_mode)
+                peak = max(peak, pinned + live + result + 3 * _image_bytes((tile_size + margin,) * 2, mode))
+            else:
+                # Pillow blurs into the result and a transposed working copy
+                peak = max(peak, pinned + live + 2 * result)
+            live = result
+
+        live = live or pinned
+
+    return peak
+
+
+def check_memory(image, plans, policy):
+    # Refuse renders of images above the pixel limit or whose estimated peak memory is above the budget
+    pixels = image.width * image.height
+    if policy.max_pixels is not None and pixels > policy.max_pixels:
+        raise MemoryBudgetExceeded(f'The image has {pixels} pixels, more than the limit of {policy.max_pixels}')
+
+    if policy.memory_budget is not None:
+        needed = estimate_memory(image, plans, policy)
+        if needed > policy.memory_budget:
+            raise MemoryBudgetExceeded(f'The edit needs about {needed // 2 ** 20} MiB, '
+                                       f'more than the budget of {policy.memory_budget // 2 ** 20} MiB')
+
+
+def affine_matrix(source_size, target_size, angle):
+    # Matrix mapping output coordinates back to the source for a resize to target_size followed by
+    # a rotation of angle degrees counter clockwise around the centre, like Image.rotate
+    scale_x = source_size[0] / target_size[0]
+    scale_y = source_size[1] / target_size[1]
+    centre_x = target_size[0] / 2.0
+    centre_y = target_size[1] / 2.0
+
+    radians = -math.radians(angle)
+    cos = round(math.cos(radians), 15)
+    sin = round(math.sin(radians), 15)
+
+    return (
+        scale_x * cos,
+        scale_x * sin,
+        scale_x * (centre_x - cos * centre_x - sin * centre_y),
+        scale_y * -sin,
+        scale_y * cos,
+        scale_y * (centre_y + sin * centre_x - cos * centre_y),
+    )
+
+
+def _apply_geometry(image, target_size, angle, tile_size=None):
+    if image.size == target_size and not angle:
+        return image
+
+    # reduce() and the smooth resamples don't work on palette and bilevel images, expand them like the
+    # thumbnails do. Plain rotations keep their nearest neighbour sampling and the image mode
+    if image.size != target_size and image.mode in ('P', '1'):
+        image = image.convert(_expanded_mode(image.mode, image.info))
+
+    # Shrink by whole factors first so the final resample never skips source pixels
+    factor_x = int(image.width / target_size[0] / REDUCING_GAP) or 1
+    factor_y = int(image.height / target_size[1] / REDUCING_GAP) or 1
+    if factor_x > 1 or factor_y > 1:
+        image = image.reduce((factor_x, factor_y))
+
+    if not angle:
+        return image.resize(target_size, Image.Resampling.BICUBIC)
+
+    # A plain rotation keeps the nearest neighbour sampling of Image.rotate. Otherwise resize and
+    # rotation are folded into one bilinear affine resample, reduce() already took care of aliasing
+    if image.size == target_size:
+        resample = Image.Resampling.NEAREST
+    else:
+        resample = Image.Resampling.BILINEAR
+
+    matrix = affine_matrix(image.size, target_size, angle)
+    if tile_size:
+        return _transform_in_tiles(image, target_size, matrix, resample, tile_size)
+    return image.transform(target_size, Image.Transform.AFFINE, matrix, resample)
+
+
+def _transform_in_tiles(image, target_size, matrix, resample, tile_size):
+    # Same result as image.transform, one output tile at a time. Every tile only transforms the part of
+    # the source its corners map to (plus a margin for the filter), instead of the whole source
+    a, b, c, d, e, f = matrix
+    result = Image.new(image.mode, target_size)
+    # Keep what image.transform would carry over, palette images need their own palette
+    result.info = image.info.copy()
+    if image.palette is not None:
+        result.putpalette(image.getpalette(image.palette.mode), image.palette.mode)
+    for top in range(0, target_size[1], tile_size):
+        for left in range(0, target_size[0], tile_size):
+            right = min(left + tile_size, target_size[0])
+            bottom = min(top + tile_size, target_size[1])
+
+            corners = [(x, y) for x in (left, right) for y in (top, bottom)]
+            xs = [a * x + b * y + c for x, y in corners]
+            ys = [d * x + e * y + f for x, y in corners]
+            box = (max(0, math.floor(min(xs)) - 2), max(0, math.floor(min(ys)) - 2),
+                   min(image.width, math.ceil(max(xs)) + 2), min(image.height, math.ceil(max(ys)) + 2))
+            if box[0] >= box[2] or box[1] >= box[3]:
+                # The tile lies entirely outside the rotated source and stays black
+                continue
+
+            # Shift the matrix so it maps tile coordinates into the cropped source
+            if resample == Image.Resampling.NEAREST:
+                tile_matrix = (a, b, _tile_offset(c, a, b, left, top, box[0]),
+                               d, e, _tile_offset(f, d, e, left, top, box[1]))
+            else:
+                tile_matrix = (a, b, a * left + b * top + c - box[0], d, e, d * left + e * top + f - box[1])
+            tile = image.crop(box).transform((right - left, bottom - top), Image.Transform.AFFINE,
+                                              tile_matrix, resample)
+            result.paste(tile, (left, top))
+    return result
+
+
+def _tile_offset(offset, step_x, step_y, left, top, origin):
+    # Pillow runs nearest neighbour affine transforms in 16.16 fixed point, stepping from the first
+    # output pixel. Start the tile on the exact value the whole-image transform reaches at (left, top),
+    # so both pick the same source pixels
+    start = _fixed(offset + step_y * 0.5 + step_x * 0.5) + top * _fixed(step_y) + left * _fixed(step_x)
+    return (start - origin * 65536) / 65536 - step_y * 0.5 - step_x * 0.5
+
+
+def _fixed(value):
+    return math.floor(value * 65536 + 0.5)
+
+
+def _draft_size(size, requested_size):
+    # Size the JPEG decoder hands back for draft(None, requested_size), see JpegImageFile.draft
+    scale = min(size[0] // requested_size[0], size[1] // requested_size[1])
+    for factor in (8, 4, 2, 1):
+        if scale >= factor:
+            break
+    return (-(-size[0] // factor), -(-size[1] // factor))
+
+
+def _expanded_mode(mode, info):
+    # Mode palette and bilevel images are resampled in, only palettes with a transparent colour need alpha
+    if mode == '1':
+        return 'L'
+    return 'RGBA' if 'transparency' in info else 'RGB'
+
+
+def _image_bytes(size, mode):
+    return size[0] * size[1] * MODE_BYTES.get(mode, 4)
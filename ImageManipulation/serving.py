@@ -0,0 +1,61 @@
+from flask import current_app, request, Response
+from werkzeug.utils import send_file
+from .instrumentation import count_read
+from .storage import file_hash
+import mimetypes
+import os
+
+# How long browsers may keep responses whose URL changes whenever their content does
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Ways of handing the file body to a front proxy, see SENDFILE_MODE
+SENDFILE_MODES = (None, 'x-sendfile', 'x-accel-redirect')
+
+
+def send_image(path, as_attachment=False, download_name=None, immutable=False):
+    # Serve path with a strong ETag derived from its content hash and a Last-Modified date, answering
+    # If-None-Match / If-Modified-Since with 304 and Range requests with 206. Images behind a
+    # versioned URL are marked immutable, everything else has to be revalidated on every use
+    mode = current_app.config['SENDFILE_MODE']
+    if mode not in SENDFILE_MODES:
+        raise ValueError(f'Unknown SENDFILE_MODE {mode!r}')
+
+    etag = file_hash(path)
+
+    if mode == 'x-accel-redirect':
+        response = _accel_redirect(path, etag, as_attachment, download_name)
+    else:
+        # With X-Sendfile the body is left to the proxy, werkzeug still handles the validators
+        response = send_file(os.path.abspath(path), request.environ, as_attachment=as_attachment,
+                             download_name=download_name, conditional=True, etag=etag,
+                             use_x_sendfile=mode == 'x-sendfile')
+        # Tell clients up front that interrupted downloads can be resumed
+        if mode is None:
+            response.accept_ranges = 'bytes'
+            # The body is streamed after the request is timed, count what it will read (nothing for a 304)
+            if response.status_code in (200, 206):
+                count_read(response.content_length or 0)
+
+    # Uploads are private to logged in users, shared caches must not keep them
+    response.cache_control.private = True
+    if immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def _accel_redirect(path, etag, as_attachment, download_name):
+    # nginx serves the bytes (and Range requests) from an internal location mapped onto the app folder
+    relative_path = os.path.relpath(os.path.abspath(path), current_app.config['SENDFILE_ROOT'])
+    prefix = current_app.config['X_ACCEL_REDIRECT_PREFIX'].rstrip('/')
+
+    download_name = download_name or os.path.basename(path)
+    response = Response(mimetype=mimetypes.guess_type(download_name)[0] or 'application/octet-stream')
+    response.headers['X-Accel-Redirect'] = f'{prefix}/{relative_path}'
+    response.headers.set('Content-Disposition', 'attachment' if as_attachment else 'inline', filename=download_name)
+    response.set_etag(etag)
+    response.last_modified = os.path.getmtime(path)
+    return response.make_conditional(request.environ)
@@ -0,0 +1,193 @@
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image as PILImage
+from sqlalchemy import or_
+from . import db
+from .models import Image, ImageHash
+from .pipeline import DRAFT_FORMATS
+import itertools
+import numpy as np
+import os
+
+# dHash of an image: its greyscale shrunk to (HASH_SIZE + 1) x HASH_SIZE pixels, one bit per pair of
+# horizontal neighbours telling whether brightness increases. Resized and re-encoded copies of a picture
+# end up a few bits apart, different pictures about half of the 64 bits apart
+HASH_SIZE = 8
+
+# The 64 bit hash is stored as BANDS bands of BAND_BITS bits, each indexed on its own
+BANDS = 4
+BAND_BITS = 16
+
+# Largest distance the band index answers cheaply: up to 2 * BANDS - 1 bits one band is at most 1 bit off,
+# 17 values per band to look up. At 2 bits off it would be 137 values, at 4 bits off 2517
+MAX_DISTANCE = 2 * BANDS - 1
+
+
+def dhash(file_path):
+    # Perceptual hash of the image in file_path as an int. JPEGs are decoded at 1/8 scale straight
+    # into greyscale, other formats have no reduced decode and are shrunk after decoding
+    with PILImage.open(file_path) as image:
+        image.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+        image = image.convert('L')
+        pixels = np.asarray(image.resize((HASH_SIZE + 1, HASH_SIZE), PILImage.Resampling.BOX, reducing_gap=2.0))
+
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(np.packbits(bits).tobytes().hex(), 16)
+
+
+def reduced_decode(file_path):
+    # Whether dhash decodes file_path at a reduced scale, only the header is read to tell
+    with PILImage.open(file_path) as image:
+        return image.format in DRAFT_FORMATS
+
+
+def split_bands(value):
+    # The bands of a hash, most significant first
+    mask = (1 << BAND_BITS) - 1
+    return [(value >> (BAND_BITS * (BANDS - 1 - band))) & mask for band in range(BANDS)]
+
+
+def hamming(first, second):
+    return bin(first ^ second).count('1')
+
+
+def band_neighbours(band, radius):
+    # Every band value within radius bits of band, band itself included
+    values = [band]
+    for flipped in range(1, radius + 1):
+        for bits in itertools.combinations(range(BAND_BITS), flipped):
+            value = band
+            for bit in bits:
+                value ^= 1 << bit
+            values.append(value)
+    return values
+
+
+def store_hash(content_hash, value):
+    # Remember the hash of the uploaded content with content_hash, the same bytes always have the same hash
+    row = db.session.get(ImageHash, content_hash)
+    if row is None:
+        row = ImageHash(content_hash=content_hash)
+        db.session.add(row)
+    row.dhash = f'{value:016x}'
+    row.band0, row.band1, row.band2, row.band3 = split_bands(value)
+    return row
+
+
+def similar_hashes(value, distance):
+    # Stored hashes within distance bits of value, as {content hash: distance}. Multi-index hashing:
+    # two hashes within distance bits have at least one band within distance // BANDS bits of each other,
+    # so only rows matching one of those band values through its index are read and compared
+    distance = min(distance, MAX_DISTANCE)
+    radius = distance // BANDS
+    columns = (ImageHash.band0, ImageHash.band1, ImageHash.band2, ImageHash.band3)
+    conditions = [column.in_(band_neighbours(band, radius)) for column, band in zip(columns, split_bands(value))]
+
+    found = {}
+    for content_hash, stored in db.session.query(ImageHash.content_hash, ImageHash.dhash).filter(or_(*conditions)):
+        bits = hamming(value, int(stored, 16))
+        if bits <= distance:
+            found[content_hash] = bits
+    return found
+
+
+def index_upload(value, content_hash, distance):
+    # Store the hash value of a new upload and return the catalog entries of other content that looks the same,
+    # closest first. Uploads of the very same bytes are not listed, the upload route reports those already
+    store_hash(content_hash, value)
+    db.session.commit()
+
+    similar = similar_hashes(value, distance)
+    similar.pop(content_hash, None)
+    if not similar:
+        return []
+    images = Image.query.filter(Image.content_hash.in_(list(similar))).all()
+    return sorted(images, key=lambda image: (similar[image.content_hash], image.filename))
+
+
+def duplicate_clusters(distance):
+    # Groups of catalog filenames whose hashes are within distance bits of each other (directly or through
+    # other members), largest first. Returns (clusters, number of catalog entries without a hash yet)
+    filenames = {}
+    unhashed = 0
+    rows = db.session.query(Image.filename, Image.content_hash, ImageHash.dhash).outerjoin(
+        ImageHash, ImageHash.content_hash == Image.content_hash)
+    for filename, content_hash, stored in rows:
+        if stored is None:
+            unhashed += 1
+        else:
+            filenames.setdefault((content_hash, int(stored, 16)), []).append(filename)
+
+    # The same multi-index lookup as similar_hashes, on in-memory band tables
+    hashes = list(filenames)
+    tables = [{} for _ in range(BANDS)]
+    for index, (_, value) in enumerate(hashes):
+        for band, table in zip(split_bands(value), tables):
+            table.setdefault(band, []).append(index)
+
+    # Union-find over the pairs found
+    parents = list(range(len(hashes)))
+
+    def find(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    # Neighbour values are worked out once per distinct band value, not once per hash
+    radius = distance // BANDS
+    for table in tables:
+        for band, members in table.items():
+            for neighbour in band_neighbours(band, radius):
+                others = table.get(neighbour)
+                if not others:
+                    continue
+                for index in members:
+                    value = hashes[index][1]
+                    for other in others:
+                        if other > index and hamming(value, hashes[other][1]) <= distance:
+                            parents[find(other)] = find(index)
+
+    clusters = {}
+    for index, key in enumerate(hashes):
+        clusters.setdefault(find(index), []).extend(filenames[key])
+    clusters = [sorted(names) for names in clusters.values() if len(names) > 1]
+    return sorted(clusters, key=lambda names: (-len(names), names[0])), unhashed
+
+
+def backfill(upload_folder, workers=None):
+    # Hash every catalog entry whose content has no hash yet on a pool of worker processes, and drop the
+    # hashes of content no longer in the catalog. Returns (hashed, failed, removed) counts
+    hashed_content = db.select(ImageHash.content_hash)
+    pending = {}
+    for filename, content_hash in db.session.query(Image.filename, Image.content_hash).filter(
+            Image.content_hash.not_in(hashed_content)):
+        pending.setdefault(content_hash, os.path.join(upload_folder, filename))
+
+    hashed = failed = 0
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            content_hashes = list(pending)
+            results = executor.map(_try_dhash, [pending[content_hash] for content_hash in content_hashes],
+                                   chunksize=16)
+            for content_hash, value in zip(content_hashes, results):
+                if value is None:
+                    failed += 1
+                    continue
+                store_hash(content_hash, value)
+                hashed += 1
+                # Commit in batches so an interrupted backfill keeps most of its work
+                if hashed % 500 == 0:
+                    db.session.commit()
+
+    catalog_content = db.select(Image.content_hash).where(Image.content_hash.is_not(None))
+    removed = ImageHash.query.filter(ImageHash.content_hash.not_in(catalog_content)).delete(synchronize_session=False)
+    db.session.commit()
+    return hashed, failed, removed
+
+
+def _try_dhash(file_path):
+    # dhash in a worker process, None for files that can't be decoded
+    try:
+        return dhash(file_path)
+    except (OSError, SyntaxError, PILImage.DecompressionBombError):
+        return None
@@ -0,0 +1,144 @@
+from collections import OrderedDict
+from PIL import Image
+from .instrumentation import phase, count_read, count_written
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+# Size of the pieces uploads are streamed and hashed in
+CHUNK_SIZE = 64 * 1024
+
+# Image formats accepted for upload, as detected from the file header
+ALLOWED_FORMATS = ('PNG', 'JPEG')
+
+# Number of file hashes remembered by file_hash
+HASH_MEMO_SIZE = 4096
+
+_hashes = OrderedDict()
+_hashes_lock = threading.Lock()
+
+
+def _read_umask():
+    # The process umask can only be read by setting it, done once while the app is imported
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# Mode of stored uploads, what a plain open() would create: temporary files are private (0600) and a front
+# proxy serving them with X-Sendfile or X-Accel-Redirect usually runs as another user
+FILE_MODE = 0o666 & ~_read_umask()
+
+
+class InvalidImage(Exception):
+    pass
+
+
+def file_hash(path):
+    # SHA-256 of the file contents, remembered per (path, inode, size, mtime) so unchanged files are read once
+    identity = _identity(path)
+
+    with _hashes_lock:
+        if identity in _hashes:
+            _hashes.move_to_end(identity)
+            return _hashes[identity]
+
+    digest = hashlib.sha256()
+    with phase('hash'), open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+            count_read(len(chunk))
+
+    _remember_hash(identity, digest.hexdigest())
+    return digest.hexdigest()
+
+
+def ingest_upload(stream, upload_folder, blob_folder, filename):
+    # Store an uploaded file under filename without ever holding it in memory. The stream is copied
+    # to a temporary file in chunks while it is hashed, the header is checked, and the bytes are kept
+    # once in blob_folder under their hash. filename is a hard link to that blob, so the same bytes
+    # uploaded under several names share one copy. Returns (hash, whether the bytes were already stored)
+    os.makedirs(blob_folder, exist_ok=True)
+
+    digest = hashlib.sha256()
+    with phase('write'), tempfile.NamedTemporaryFile(dir=blob_folder, suffix='.tmp', delete=False) as temporary:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            temporary.write(chunk)
+            count_written(len(chunk))
+
+    try:
+        with phase('validate'):
+            validate_image_header(temporary.name)
+
+        content_hash = digest.hexdigest()
+        blob_path = os.path.join(blob_folder, content_hash)
+        duplicate = os.path.exists(blob_path)
+        if duplicate:
+            os.remove(temporary.name)
+        else:
+            os.chmod(temporary.name, FILE_MODE)
+            os.replace(temporary.name, blob_path)
+    except BaseException:
+        if os.path.exists(temporary.name):
+            os.remove(temporary.name)
+        raise
+
+    file_path = os.path.join(upload_folder, filename)
+    try:
+        os.link(blob_path, file_path)
+    except FileExistsError:
+        _remove_unreferenced(blob_path)
+        raise
+    except OSError:
+        # The file system has no hard links, fall back to a private copy
+        shutil.copyfile(blob_path, file_path)
+
+    _remember_hash(_identity(file_path), content_hash)
+    return content_hash, duplicate
+
+
+def remove_upload(upload_folder, blob_folder, filename):
+    # Remove filename and its blob once no other name refers to it anymore
+    file_path = os.path.join(upload_folder, filename)
+    blob_path = os.path.join(blob_folder, file_hash(file_path))
+    os.remove(file_path)
+    _remove_unreferenced(blob_path)
+
+
+def validate_image_header(path):
+    # Image.open only parses the header, the pixel data is not decoded here
+    try:
+        with Image.open(path) as image:
+            if image.format not in ALLOWED_FORMATS:
+                raise InvalidImage(f'Unsupported image format {image.format}')
+            if image.width < 1 or image.height < 1:
+                raise InvalidImage('Image has no pixels')
+            # Pillow only raises its decompression bomb error at twice MAX_IMAGE_PIXELS, refuse anything above it
+            if Image.MAX_IMAGE_PIXELS is not None and image.width * image.height > Image.MAX_IMAGE_PIXELS:
+                raise InvalidImage(f'Image has more than {Image.MAX_IMAGE_PIXELS} pixels')
+    except (OSError, SyntaxError, Image.DecompressionBombError) as error:
+        raise InvalidImage(str(error)) from error
+
+
+def _remove_unreferenced(blob_path):
+    # A blob linked from no upload only has its own name left
+    try:
+        if os.stat(blob_path).st_nlink == 1:
+            os.remove(blob_path)
+    except FileNotFoundError:
+        pass
+
+
+def _identity(path):
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _remember_hash(identity, content_hash):
+    with _hashes_lock:
+        _hashes[identity] = content_hash
+        while len(_hashes) > HASH_MEMO_SIZE:
+            _hashes.popitem(last=False)
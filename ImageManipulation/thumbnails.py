@@ -0,0 +1,143 @@
+from collections import OrderedDict
+from PIL import Image
+from .encoding import EXTENSIONS, encode
+import os
+import threading
+
+
+class ThumbnailCache:
+    # On-disk cache of downscaled copies of the uploads, bounded in bytes and evicted least recently used first
+
+    def __init__(self, app=None):
+        self.folder = None
+        self.max_bytes = 0
+        self.preset = None
+        # Maps thumbnail path -> size in bytes, least recently used first
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.folder = app.config['THUMBNAIL_FOLDER']
+        self.max_bytes = app.config['THUMBNAIL_CACHE_MAX_BYTES']
+        self.preset = app.config['THUMBNAIL_PRESET']
+        app.extensions['thumbnail_cache'] = self
+
+        # The folder may have changed, index it again on first use
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+            self._loaded = False
+
+    def get(self, source_path, filename, size, image_format=None):
+        # Return the path to a thumbnail of source_path no larger than size x size, building it if needed.
+        # Thumbnails are encoded in the source's format unless image_format asks for another one
+        path = os.path.join(self.folder, str(size), self._thumbnail_name(filename, image_format))
+
+        with self._lock:
+            self._load()
+            if path in self._entries and not self._is_stale(source_path, path):
+                self._entries.move_to_end(path)
+                return path
+
+        self._build(source_path, path, size, image_format)
+
+        with self._lock:
+            self._forget(path)
+            self._entries[path] = os.path.getsize(path)
+            self._total_bytes += self._entries[path]
+            self._evict()
+        return path
+
+    def invalidate(self, filename):
+        # Drop every cached size and format of filename, called whenever the source image changes or is removed
+        names = [filename] + [filename + extension for extension in EXTENSIONS.values()]
+        with self._lock:
+            self._load()
+            for size_folder in self._size_folders():
+                for name in names:
+                    path = os.path.join(size_folder, name)
+                    self._forget(path)
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def _thumbnail_name(self, filename, image_format):
+        # Thumbnails in another format than the source get that format's extension appended
+        extension = os.path.splitext(filename)[1].lower()
+        if image_format is None or Image.registered_extensions().get(extension) == image_format:
+            return filename
+        return filename + EXTENSIONS[image_format]
+
+    def _build(self, source_path, path, size, image_format=None):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with Image.open(source_path) as image:
+            image_format = image_format or image.format
+            palette = image.mode == 'P'
+
+            # Palette images would be resampled with nearest neighbour, expand them first. Only
+            # palettes with a transparent colour need an alpha channel
+            if image.mode == 'P':
+                image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+            elif image.mode == '1':
+                image = image.convert('L')
+
+            # thumbnail() asks the JPEG decoder for a 1/2, 1/4 or 1/8 scale draft and then
+            # shrinks by whole factors with reduce() before the final resample, so large
+            # originals are never decoded at full resolution
+            image.thumbnail((size, size), reducing_gap=2.0)
+
+            # Resampling adds colours, put palette PNGs back on a palette or the thumbnail can outgrow the original
+            if palette and image_format == 'PNG':
+                image = image.quantize(256)
+
+            # Thumbnails are encoded once and sent many times, see THUMBNAIL_PRESET
+            encode(image, path, image_format, self.preset)
+
+    def _is_stale(self, source_path, path):
+        # The source was replaced behind our back (or the thumbnail was removed)
+        try:
+            return os.path.getmtime(source_path) > os.path.getmtime(path)
+        except OSError:
+            return True
+
+    def _load(self):
+        # Rebuild the LRU index from disk the first time the cache is used, oldest files first
+        if self._loaded:
+            return
+        self._loaded = True
+
+        found = []
+        for size_folder in self._size_folders():
+            for entry in os.scandir(size_folder):
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, entry.path, stat.st_size))
+
+        for _, path, size in sorted(found):
+            self._entries[path] = size
+            self._total_bytes += size
+
+    def _forget(self, path):
+        size = self._entries.pop(path, None)
+        if size is not None:
+            self._total_bytes -= size
+
+    def _evict(self):
+        # Remove least recently used thumbnails until the cache fits its byte budget
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            path, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _size_folders(self):
+        if not os.path.isdir(self.folder):
+            return []
+        return [entry.path for entry in os.scandir(self.folder) if entry.is_dir()]
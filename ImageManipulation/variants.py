@@ -0,0 +1,197 @@
+from PIL import Image
+from .encoding import encode
+from .instrumentation import phase, count_written
+from .pipeline import TransformPlan, RenderPolicy, render, apply_plan, check_memory
+from .storage import file_hash
+import hashlib
+import json
+import os
+import threading
+
+# Formats that survive re-encoding unchanged, only their intermediate variants are reused as a starting point
+LOSSLESS_FORMATS = ('PNG',)
+
+
+def normalize_operations(operations):
+    # Canonical form of an edit chain: no-op steps are dropped. Everything else changes the pixels,
+    # even a resize straight after another one resamples twice, so it is kept
+    steps = []
+    for operation in operations:
+        step = TransformPlan.from_dict(operation).to_dict()
+        if step:
+            steps.append(step)
+    return steps
+
+
+def variant_key(source_hash, steps):
+    chain = json.dumps(steps, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(f'{source_hash}:{chain}'.encode()).hexdigest()
+
+
+def variant_version(content_hash, operations):
+    # Short token that changes whenever the edited image does, used to version image URLs
+    return variant_key(content_hash, normalize_operations(operations))[:16]
+
+
+def render_variant(source_path, steps, paths, policy=None):
+    # Render source_path with the normalized steps into paths[-1], where paths[k] is the variant
+    # holding the first k + 1 steps. Runs in a worker process as well as inline. policy sets the
+    # memory limits and encoder preset, large images are processed in tiles
+    if os.path.exists(paths[-1]):
+        return paths[-1]
+
+    if policy is None:
+        policy = RenderPolicy()
+
+    extension = os.path.splitext(source_path)[1].lower()
+    image_format = Image.registered_extensions()[extension]
+
+    # Lossless variants of a shorter chain can be picked up where they left off,
+    # lossy ones are always rendered from the original to avoid generation loss
+    start, start_path = 0, source_path
+    if image_format in LOSSLESS_FORMATS:
+        for applied in range(len(steps) - 1, 0, -1):
+            if os.path.exists(paths[applied - 1]):
+                start, start_path = applied, paths[applied - 1]
+                break
+
+    plans = [TransformPlan.from_dict(step) for step in steps[start:]]
+    with Image.open(start_path) as image:
+        check_memory(image, plans, policy)
+
+    image = render(start_path, plans[0], policy)
+    for plan in plans[1:]:
+        image = apply_plan(image, plan, policy.tile_size_for(image.size))
+
+    os.makedirs(os.path.dirname(paths[-1]), exist_ok=True)
+    with phase('encode'):
+        encode(image, paths[-1], image_format, policy.preset)
+    count_written(os.path.getsize(paths[-1]))
+    return paths[-1]
+
+
+class VariantStore:
+    # Rendered edits cached on disk under a key of (source content hash, normalized edit chain)
+
+    def __init__(self, app=None):
+        self.folder = None
+        self.policy = None
+        # Variant paths a queued job is rendering, they are never rendered again in a request meanwhile
+        self._rendering = set()
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.folder = app.config['VARIANT_FOLDER']
+        self.policy = RenderPolicy(max_pixels=app.config['MAX_IMAGE_PIXELS'],
+                                   large_image_pixels=app.config['LARGE_IMAGE_PIXELS'],
+                                   memory_budget=app.config['IMAGE_MEMORY_BUDGET'],
+                                   tile_size=app.config['LARGE_IMAGE_TILE_SIZE'],
+                                   preset=app.config['ENCODING_PRESET'])
+        app.extensions['variant_store'] = self
+
+    def variant_path(self, source_path, steps):
+        extension = os.path.splitext(source_path)[1].lower()
+        return os.path.join(self.folder, variant_key(file_hash(source_path), steps) + extension)
+
+    def prefix_paths(self, source_path, steps):
+        # Variant path for every prefix of steps, the last one is the fully edited image
+        return [self.variant_path(source_path, steps[:applied]) for applied in range(1, len(steps) + 1)]
+
+    def current_path(self, source_path, operations):
+        # Path of the image with operations applied. Returns (path, whether a job is still rendering the
+        # edits, error of a render that failed on the way or None).
+        # While a job renders the variant the longest prefix already on disk is returned, otherwise variants
+        # that are not cached yet are rendered now. An edit that can't be rendered is skipped with every
+        # edit after it, the image is then the longest prefix of operations that did render
+        steps = normalize_operations(operations)
+        paths = self.prefix_paths(source_path, steps)
+        usable, error = self._usable_steps(paths)
+
+        if usable and not os.path.exists(paths[usable - 1]) and self.is_rendering(paths[usable - 1]):
+            path, _ = self.latest_rendered(source_path, operations)
+            return path, True, error
+
+        for applied in range(usable, 0, -1):
+            try:
+                return render_variant(source_path, steps[:applied], paths[:applied], self.policy), False, error
+            except Exception as render_error:
+                # Whatever broke the render breaks it again, remember it instead of retrying on every request
+                self.record_error(paths[applied - 1], render_error)
+                error = str(render_error) or render_error.__class__.__name__
+        return source_path, False, error
+
+    def start_rendering(self, path):
+        # A job was queued to render the variant at path
+        with self._lock:
+            self._rendering.add(path)
+
+    def finish_rendering(self, path):
+        # The job rendering the variant at path is done, the variant or its error is on disk
+        with self._lock:
+            self._rendering.discard(path)
+
+    def is_rendering(self, path):
+        with self._lock:
+            return path in self._rendering
+
+    def latest_rendered(self, source_path, operations):
+        # The variant of the longest prefix of operations already on disk and the steps it is still missing,
+        # the original and every step when none is. Never renders anything, the latest edit may still be queued.
+        # Edits whose render failed are left out like in current_path
+        steps = normalize_operations(operations)
+        paths = self.prefix_paths(source_path, steps)
+        usable, _ = self._usable_steps(paths)
+        for applied in range(usable, 0, -1):
+            if os.path.exists(paths[applied - 1]):
+                return paths[applied - 1], steps[applied:usable]
+        return source_path, steps[:usable]
+
+    def record_error(self, path, error):
+        # Remember that the variant at path could not be rendered, next to where it would have been stored
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.error', 'w') as file:
+            file.write(str(error) or error.__class__.__name__)
+
+    def clear_errors(self, paths):
+        # Forget failed renders of the variants at paths so they are tried again
+        for path in paths:
+            if os.path.exists(path + '.error'):
+                os.remove(path + '.error')
+
+    def check_memory(self, source_path, steps):
+        # Raise MemoryBudgetExceeded when rendering steps from source_path would not fit the memory budget
+        with Image.open(source_path) as image:
+            check_memory(image, [TransformPlan.from_dict(step) for step in steps], self.policy)
+
+    def discard(self, source_path, operations, keep=(), shared=()):
+        # Remove cached variants of every prefix of operations that is not also a prefix of keep. Variants
+        # are keyed by content, shared lists the operations of other names with the same bytes, whose
+        # variants are kept as well
+        kept = set(self._operation_paths(source_path, keep))
+        for other in shared:
+            kept.update(self._operation_paths(source_path, other))
+        for path in self._operation_paths(source_path, operations):
+            if path not in kept:
+                for stored in (path, path + '.error'):
+                    if os.path.exists(stored):
+                        os.remove(stored)
+
+    def _operation_paths(self, source_path, operations):
+        paths = []
+        for applied in range(1, len(operations) + 1):
+            steps = normalize_operations(operations[:applied])
+            if steps:
+                paths.append(self.variant_path(source_path, steps))
+        return paths
+
+    def _usable_steps(self, paths):
+        # How many steps can be rendered: every chain holding a step whose render failed fails as well.
+        # Returns (steps before the first failed one, its error or None)
+        for applied, path in enumerate(paths):
+            if os.path.exists(path + '.error'):
+                with open(path + '.error') as file:
+                    return applied, file.read()
+        return len(paths), None
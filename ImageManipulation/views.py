@@ -1,7 +1,22 @@
-from flask import Blueprint, current_app , render_template, request, redirect, url_for, flash, send_file
-from flask_login import login_required
-from PIL import Image, ImageEnhance
+from flask import Blueprint, current_app , render_template, request, redirect, url_for, flash, abort, jsonify, Response
+from flask_login import login_required, current_user
+from concurrent.futures.process import BrokenProcessPool
 from werkzeug.utils import secure_filename
+from PIL import Image as PILImage
+from . import db, thumbnail_cache, job_queue, variant_store, metrics, user_cache, password_hasher
+from .archives import stream_zip
+from .catalog import add_image, remove_image, list_page
+from .encoding import encode_bytes, negotiate_format
+from .jobs import QueueFull
+from .instrumentation import phase
+from .models import EditHistory, Image
+from .pipeline import TransformPlan, build_plan, render_preview, MemoryBudgetExceeded
+from .storage import ingest_upload, remove_upload, file_hash, InvalidImage
+from .serving import send_image
+from .similarity import dhash, index_upload, duplicate_clusters, reduced_decode, MAX_DISTANCE
+from .variants import normalize_operations, render_variant, variant_version
+import hmac
+import math
 import os
 
 views = Blueprint("views", __name__)
@@ -36,14 +51,6 @@ def upload_image():
         # Ensure the file name is secure
         filename = secure_filename(file.filename)
 
-        # Check if file is a valid image
-        try:
-            Image.open(file).verify()
-        except Exception:
-            flash('Invalid image file', category='danger')
-            return redirect(url_for('views.upload_image'))
-        file.seek(0) # Reset the file pointer
-
         # If the uploads folder does not exist, create one
         if not os.path.exists(current_app.config['UPLOAD_FOLDER']):
             os.makedirs(current_app.config['UPLOAD_FOLDER'])
@@ -53,10 +60,43 @@ def upload_image():
             flash('File already exists', category='danger')
             return redirect(url_for('views.upload_image'))
         
-        # Save the file to the upload folder
-        file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
+        # Stream the file to the blob store while hashing it, only its header is checked
+        try:
+            content_hash, duplicate = ingest_upload(file.stream, current_app.config['UPLOAD_FOLDER'],
+                                                    current_app.config['BLOB_FOLDER'], filename)
+        except InvalidImage:
+            flash('Invalid image file', category='danger')
+            return redirect(url_for('views.upload_image'))
+        except FileExistsError:
+            flash('File already exists', category='danger')
+            return redirect(url_for('views.upload_image'))
+
+        # Index the new file so listings never have to scan the upload folder
+        with phase('catalog'):
+            add_image(current_app.config['UPLOAD_FOLDER'], filename, owner_id=current_user.id, content_hash=content_hash)
+
+        if duplicate:
+            flash(f'File {filename} successfully uploaded, identical content was already stored and is shared', category='success')
+        else:
+            flash(f'File {filename} successfully uploaded', category='success')
 
-        flash(f'File {filename} successfully uploaded', category='success')
+        # Warn about earlier uploads of the same picture, resized or encoded differently. JPEGs are hashed
+        # from a 1/8 scale decode right here, other formats are decoded whole and that runs on the job queue
+        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+        similar = []
+        try:
+            with phase('dhash'):
+                if reduced_decode(file_path):
+                    value = dhash(file_path)
+                else:
+                    value = job_queue.run(dhash, file_path, timeout=current_app.config['UPLOAD_HASH_TIMEOUT'])
+            similar = index_upload(value, content_hash, current_app.config['DUPLICATE_HASH_DISTANCE'])
+        except (OSError, QueueFull, TimeoutError, BrokenProcessPool):
+            # The pixel data is broken or the queue is busy, `flask hash-images` will hash it (or report it)
+            pass
+        if similar:
+            names = ', '.join(image.filename for image in similar[:5])
+            flash(f'File {filename} looks like a near-duplicate of {names}', category='warning')
         return redirect(url_for('views.upload_image'))
     
     # GET
@@ -70,32 +110,43 @@ def list_images_page():
 
         return redirect(url_for('views.list_images_page'))
 
-    images = list_images()
-    return render_template("list_images.html", images=images)
+    pagination = image_page()
+    images = [image.filename for image in pagination.items]
+    return render_template("list_images.html", images=images, pagination=pagination,
+                           versions=image_versions(pagination.items))
+
+
+def image_page():
+    # Page of the image catalog selected by the page, per_page, sort and order query arguments
+    per_page = request.args.get('per_page', current_app.config['CATALOG_PAGE_SIZE'], type=int)
+    per_page = max(1, min(per_page, current_app.config['CATALOG_MAX_PAGE_SIZE']))
+    return list_page(page=request.args.get('page', 1, type=int), per_page=per_page,
+                     sort=request.args.get('sort', 'name'), order=request.args.get('order', 'asc'))
+
+
+def image_versions(images):
+    # Current version of every catalog entry, thumbnails are linked with it so they can be cached for good
+    filenames = [image.filename for image in images]
+    histories = {
+        history.filename: history.applied_operations()
+        for history in EditHistory.query.filter(EditHistory.filename.in_(filenames))
+    }
+    return {image.filename: variant_version(image.content_hash, histories.get(image.filename, [])) for image in images}
 
 
 @views.route("/list-images", methods=["GET"])
 @login_required
 def list_images():
-    # Get the path to the upload folder
-    upload_folder = current_app.config['UPLOAD_FOLDER']
-    
-    # Get the list of files in the upload folder
-    files = os.listdir(upload_folder)
+    # Get one page of images from the catalog
+    pagination = image_page()
 
     # if there are no files, return error message
-    if len(files) == 0:
+    if pagination.total == 0:
         flash('No files found', category='danger')
         return redirect(url_for('views.list_images_page'))
-    
-    # Filter the list of files to only include images
-    image_files = []
-    for file_name in files:
-        if file_name.endswith(('.png', '.jpg', '.jpeg')):
-            image_files.append(file_name)
 
     # Return the list of files
-    return image_files
+    return [image.filename for image in pagination.items]
 
 
 @views.route("/delete-image/<filename>", methods=["POST"])
@@ -109,8 +160,15 @@ def delete_image(filename):
     
     # Check if the file exists
     if os.path.exists(file_path):
-        # Delete the file
-        os.remove(file_path)
+        # Delete the file together with its edit history and rendered variants
+        history = EditHistory.query.filter_by(filename=filename).first()
+        if history:
+            variant_store.discard(file_path, history.operations, shared=shared_operations(filename))
+            db.session.delete(history)
+            db.session.commit()
+        remove_upload(upload_folder, current_app.config['BLOB_FOLDER'], filename)
+        remove_image(filename)
+        thumbnail_cache.invalidate(filename)
         flash(f'Image {filename} deleted successfully', category='success')
         return redirect(url_for('views.list_images_page'))
     else:
@@ -125,34 +183,123 @@ def download_image(filename):
 
     # Get the full path to the image file
     file_path = os.path.join(upload_folder, filename)
-    
-    # Save absolute path to a new var
-    absolute_file_path = os.path.abspath(file_path)
 
     # Check if the file exists
     if os.path.exists(file_path):
-        return send_file(absolute_file_path, as_attachment=True)
+        # Serve the image with its applied edits, under its original name
+        current_path, _, error = current_image_path(filename)
+        if error:
+            flash(f'Some edits of {filename} could not be applied and were left out: {error}', category='danger')
+        return send_image(current_path, as_attachment=True, download_name=filename)
     else:
         flash(f'The image "{filename}" was not found', category='danger')
         return redirect(url_for('views.list_images_page'))
 
+@views.route("/thumbnail/<filename>", methods=["GET"])
+@login_required
+def thumbnail(filename):
+    # Get the full path to the original image
+    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+    if not os.path.isfile(file_path):
+        abort(404)
+
+    # Only sizes listed in the config are cached, anything else falls back to the smallest
+    sizes = current_app.config['THUMBNAIL_SIZES']
+    size = request.args.get('size', sizes[0], type=int)
+    if size not in sizes:
+        size = sizes[0]
+
+    # Edited images get thumbnails of their own, named after the rendered variant
+    history = EditHistory.query.filter_by(filename=filename).first()
+    operations = history.applied_operations() if history else []
+    current_path, rendering, error = variant_store.current_path(file_path, operations)
+    thumbnail_name = filename if current_path == file_path else os.path.basename(current_path)
+
+    # A URL carrying the current version never changes content, browsers may keep it for good.
+    # Images shown without edits that are still rendering or failed to render change later
+    version = variant_version(file_hash(file_path), operations)
+    immutable = request.args.get('v') == version and not rendering and error is None
+
+    # Browsers that accept WebP get a (much smaller) WebP thumbnail, cached next to the original format one
+    image_format = None
+    if current_app.config['WEBP_THUMBNAILS']:
+        image_format = negotiate_format(request.accept_mimetypes, None)
+
+    thumbnail_path = thumbnail_cache.get(current_path, thumbnail_name, size, image_format)
+    response = send_image(thumbnail_path, immutable=immutable)
+    if current_app.config['WEBP_THUMBNAILS']:
+        response.vary.add('Accept')
+    return response
+
+@views.route("/preview-image/<filename>", methods=["GET"])
+@login_required
+def preview_image(filename):
+    # Get the full path to the original image
+    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+    if not os.path.isfile(file_path):
+        abort(404)
+
+    # The manipulations come in the query string, validated like the modify form
+    plan, error = validate_manipulations(request.args)
+    if error:
+        return jsonify(error=error), 400
+
+    # Previews are rendered on a cached proxy of the latest variant already on disk, nothing is stored.
+    # Applied edits still waiting for their job are redone on the proxy, full resolution renders only
+    # ever run on the job queue
+    history = EditHistory.query.filter_by(filename=filename).first()
+    operations = history.applied_operations() if history else []
+    rendered_path, pending = variant_store.latest_rendered(file_path, operations)
+    proxy_name = filename if rendered_path == file_path else os.path.basename(rendered_path)
+    proxy_path = thumbnail_cache.get(rendered_path, proxy_name, current_app.config['PREVIEW_SIZE'])
+    with PILImage.open(rendered_path) as image:
+        full_size = image.size
+    plans = [TransformPlan.from_dict(step) for step in pending] + [plan]
+    preview = render_preview(proxy_path, plans, full_size)
+
+    # JPEG encodes fastest, images with transparency are sent as WebP to clients that accept it or as PNG
+    image_format = 'JPEG'
+    if 'A' in preview.getbands() or 'transparency' in preview.info:
+        image_format = negotiate_format(request.accept_mimetypes, 'PNG')
+    with phase('encode'):
+        data = encode_bytes(preview, image_format, current_app.config['PREVIEW_PRESET'])
+
+    response = Response(data, mimetype=PILImage.MIME[image_format])
+    # Previews are private and change whenever the image is edited
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Accept')
+    return response
+
+@views.route("/duplicates", methods=["GET"])
+@login_required
+def duplicates():
+    # Groups of catalog images that look the same. The distance query argument is the number of
+    # hash bits (out of 64) that may differ, capped at what the hash index answers cheaply
+    distance = request.args.get('distance', current_app.config['DUPLICATE_HASH_DISTANCE'], type=int)
+    distance = max(0, min(distance, MAX_DISTANCE))
+
+    clusters, unhashed = duplicate_clusters(distance)
+    return jsonify(distance=distance, clusters=clusters, unhashed=unhashed)
+
 @views.route("/modify-image-page", methods=["GET"])
 @login_required
 def modify_image_page():
-    # Get list of images
-    images = list_images() 
-    print(images)
-    return render_template("modify_image.html", images=images)
+    return render_modify_image_page()
 
 
-@views.route("/modify-image/<filename>", methods=["POST"])
-@login_required
-def modify_image(filename):
-    # Get path to the upload folder
-    upload_folder = current_app.config['UPLOAD_FOLDER']
+def render_modify_image_page(status=200):
+    # Only one page of images gets a modify form
+    pagination = image_page()
+    images = [image.filename for image in pagination.items]
+    # Refused edits render this page from the POST route, keep the page links on the page itself
+    return render_template("modify_image.html", images=images, pagination=pagination,
+                           versions=image_versions(pagination.items), page_endpoint='views.modify_image_page'), status
 
-    # Get the full path to the image
-    file_path = os.path.join(upload_folder, filename)
+
+def validate_manipulations(form):
+    # Validate the manipulation fields of a modify request and compile them into a plan.
+    # Returns (plan, None) when the request is valid and (None, error message) otherwise
 
     # Function to check if a value is a float
     def is_float(value):
@@ -161,94 +308,411 @@ def modify_image(filename):
             return True
         except ValueError:
             return False
-        
+
+    # Get the request data
+    width = form.get('width')
+    height = form.get('height')
+    rotate = form.get('rotate')
+    contrast = form.get('contrast')
+    brightness = form.get('brightness')
+    saturation = form.get('saturation')
+    gamma = form.get('gamma')
+    levels_black = form.get('levels_black')
+    levels_white = form.get('levels_white')
+    blur = form.get('blur')
+    blur_mode = form.get('blur_mode') or 'gaussian'
+    # Checkboxes are only sent when ticked
+    equalize = form.get('equalize') == 'on'
+
+    # Ensure at least one manipulation was passed
+    if not any([width, height, rotate, contrast, brightness, saturation, gamma, levels_black, levels_white,
+                blur, equalize]):
+        return None, 'At least one manipulation is required'
+
+    # Ensure only numbers are passed in the request and convert them to int except for the factors and the blur radius
+    variables = [('width', width), ('height', height), ('rotate', rotate), ('contrast', contrast),
+                 ('brightness', brightness), ('saturation', saturation), ('gamma', gamma),
+                 ('levels_black', levels_black), ('levels_white', levels_white), ('blur', blur)]
+    float_fields = ('contrast', 'brightness', 'saturation', 'gamma', 'blur')
+    values = {}
+
+    for name, var in variables:
+        label = name.replace('_', ' ').capitalize()
+        if var is not None and var != '':
+            if not is_float(var):
+                return None, f'{label} must be a number'
+            # float() also parses nan and inf, which no range check catches and no edit can use
+            elif not math.isfinite(float(var)):
+                return None, f'{label} must be a finite number'
+            elif float(var) < 0:
+                return None, f'{label} must not be negative'
+            elif name in float_fields:
+                values[name] = float(var)
+            else:
+                values[name] = int(float(var))
+
+    width = values.get('width')
+    height = values.get('height')
+    rotate = values.get('rotate')
+    contrast = values.get('contrast')
+    brightness = values.get('brightness')
+    saturation = values.get('saturation')
+    gamma = values.get('gamma')
+    blur = values.get('blur')
+
+    # Check for desired manipulations
+    if width and height:
+        MAX_SIZE = (1920, 1080)
+        # If width or height is greater than the max size return error message
+        if width > MAX_SIZE[0] or height > MAX_SIZE[1]:
+            return None, f'Width and height must be less than {MAX_SIZE[0]} and {MAX_SIZE[1]} respectively'
+
+    # If only one field was passed return error message
+    elif width or height:
+        return None, 'Both width and height are required for resizing'
+
+    if rotate:
+        # if rotate greater than 360 or less than 0 return error message
+        if rotate >= 360:
+            return None, 'Rotation must be between 0 and 359'
+
+    if contrast:
+        if contrast > 10:
+            return None, 'Contrast must be between 0 and 10'
+
+    if brightness is not None and brightness > 10:
+        return None, 'Brightness must be between 0 and 10'
+
+    if saturation is not None and saturation > 10:
+        return None, 'Saturation must be between 0 and 10'
+
+    if gamma is not None and not 0.1 <= gamma <= 10:
+        return None, 'Gamma must be between 0.1 and 10'
+
+    # Levels stretch the input range black..white, a missing end keeps its default
+    levels = None
+    if 'levels_black' in values or 'levels_white' in values:
+        levels = (values.get('levels_black', 0), values.get('levels_white', 255))
+        if levels[1] > 255 or levels[0] >= levels[1]:
+            return None, 'Levels black point must be below the white point, both between 0 and 255'
+
+    if blur is not None and not 0 <= blur <= 100:
+        return None, 'Blur radius must be between 0 and 100'
+    if blur_mode not in ('gaussian', 'box'):
+        return None, 'Blur must be gaussian or box'
+
+    # Compile the manipulations into one plan so they can be applied in a single pass
+    plan = build_plan(width=width, height=height, rotate=rotate, contrast=contrast, brightness=brightness,
+                      saturation=saturation, gamma=gamma, levels=levels, equalize=equalize, blur=blur,
+                      blur_mode=blur_mode)
+
+    # Values that leave the image as it is (a rotation of 0, the full levels range) are no manipulation
+    # either, they must not end up in the edit history
+    if not plan.to_dict():
+        return None, 'At least one manipulation is required'
+    return plan, None
+
+
+def get_history(filename):
+    # Edit history of filename, a new empty one is added to the session if there is none yet
+    history = EditHistory.query.filter_by(filename=filename).first()
+    if history is None:
+        history = EditHistory(filename=filename, operations=[], position=0)
+        db.session.add(history)
+    return history
+
+
+def append_edit(filename, plan):
+    # Append plan to the history of filename, replacing any undone steps. Returns the history and
+    # its previous operations, whose variants are discarded once the session is committed
+    history = get_history(filename)
+    discarded = history.operations
+    history.operations = history.applied_operations() + [plan.to_dict()]
+    history.position = len(history.operations)
+    return history, discarded
+
+
+def shared_operations(filename):
+    # Edit histories (undone steps included) of the other upload names with the same bytes as filename.
+    # Variants are keyed by content, so those names use the same variant files
+    image = Image.query.filter_by(filename=filename).first()
+    if image is None or image.content_hash is None:
+        return []
+    names = db.select(Image.filename).where(Image.content_hash == image.content_hash, Image.filename != filename)
+    return [history.operations for history in EditHistory.query.filter(EditHistory.filename.in_(names))]
+
+
+def history_state(history):
+    return {
+        'filename': history.filename,
+        'operations': history.operations,
+        'position': history.position,
+    }
+
+
+def current_image_path(filename):
+    # Path of the image as the user currently sees it: the original, or the variant with its applied edits.
+    # Returns (path, whether a job is still rendering edits left out of it, error of an edit that failed
+    # to render and was left out or None)
+    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+    history = EditHistory.query.filter_by(filename=filename).first()
+    if history is None:
+        return file_path, False, None
+    return variant_store.current_path(file_path, history.applied_operations())
+
+
+def wants_json():
+    # API clients ask for JSON, browsers submitting the form get flash messages and redirects
+    return request.accept_mimetypes.accept_json and not request.accept_mimetypes.accept_html
+
+
+@views.route("/modify-image/<filename>", methods=["POST"])
+@login_required
+def modify_image(filename):
+    # Get path to the upload folder
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+
+    # Get the full path to the image
+    file_path = os.path.join(upload_folder, filename)
+
     # Check if the file exists
-    if os.path.exists(file_path):
-        # Open the image using pillow
-        image = Image.open(file_path)
-
-        # Get the request data
-        width = request.form.get('width')
-        height = request.form.get('height')
-        rotate = request.form.get('rotate')
-        contrast = request.form.get('contrast')
-
-        # Ensure at least one manipulation was passed
-        if not any([width, height, rotate, contrast]):
-            flash('At least one manipulation is required', category='danger')
-            return redirect(url_for('views.modify_image_page'))
-
-        # Ensure only numbers are passed in the request and convert them to int except for contrast
-        variables = [('width', width), ('height', height), ('rotate', rotate), ('contrast', contrast)]
-
-        # print(type(width), type(height), type(rotate), type(contrast))
-        # print(width, height, rotate, contrast)
-
-        for name, var in variables:
-            if var is not None and var != '':
-                if not is_float(var):
-                    flash(f'{name.capitalize()} must be a number', category='danger')
-                    return redirect(url_for('views.modify_image_page'))
-                elif float(var) < 0:
-                    flash(f'{name.capitalize()} must not be negative', category='danger')
-                    return redirect(url_for('views.modify_image_page'))
-                else:
-                    if name == 'contrast':
-                        contrast = float(var)
-                    else:
-                        var = int(var)
-                        if name == 'width':
-                            width = var
-                        elif name == 'height':
-                            height = var
-                        elif name == 'rotate':
-                            rotate = var   
-
-        # Check for desired manipulations
-        if width and height:
-            print('RESIZE got here!!!!')
-            MAX_SIZE = (1920, 1080)
-            # If width or height is greater than the max size return error message
-            if width > MAX_SIZE[0] or height > MAX_SIZE[1]:
-                flash(f'Width and height must be less than {MAX_SIZE[0]} and {MAX_SIZE[1]} respectively', category='danger')
-                return redirect(url_for('views.modify_image_page'))
-            
-            # Apply resize
-            image = image.resize((width, height))
-        
-        # If only one field was passed return error message
-        elif width or height:
-            flash('Both width and height are required for resizing', category='danger')
-            return redirect(url_for('views.modify_image_page'))
-
-        if rotate:
-            print('ROTATE got here!!!!')
-            # if rotate greater than 360 or less than 0 return error message
-            if rotate >= 360:
-                flash('Rotation must be between 0 and 359', category='danger')
-                return redirect(url_for('views.modify_image_page'))
-
-            # Apply rotation
-            image = image.rotate(rotate)
-
-        if contrast:
-            print('CONTRAST got here!!!!')
-            # Convert image to RGB mode if it's not
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            elif contrast > 10:
-                flash('Contrast must be between 0 and 10', category='danger')
-                return redirect(url_for('views.modify_image_page'))
-            
-            # Apply contrast
-            image = ImageEnhance.Contrast(image).enhance(contrast)
-        
-        # Save the modified image
-        image.save(file_path)
+    if not os.path.exists(file_path):
+        if wants_json():
+            return jsonify(error=f'The image "{filename}" was not found'), 404
+        flash(f'The image "{filename}" was not found', category='danger')
+        return redirect(url_for('views.modify_image_page'))
 
-        # Return a success message
-        flash(f'Image {filename} modified successfully', category='success')
+    # Validation still happens in the request, only valid edits are queued
+    plan, error = validate_manipulations(request.form)
+    if error:
+        if wants_json():
+            return jsonify(error=error), 400
+        flash(error, category='danger')
         return redirect(url_for('views.modify_image_page'))
+
+    # The original is never touched, the edit is appended to the image history
+    history, discarded = append_edit(filename, plan)
+
+    # Render the new variant on the worker pool so it is ready when the image is next viewed
+    steps = normalize_operations(history.operations)
+    job = None
+    if steps:
+        # Edits that would not fit the memory budget are refused before anything is queued
+        try:
+            variant_store.check_memory(file_path, steps)
+        except MemoryBudgetExceeded as error:
+            db.session.rollback()
+            if wants_json():
+                return jsonify(error=str(error)), 413
+            flash(str(error), category='danger')
+            return render_modify_image_page(413)
+
+        # Submitting an edit again retries it when an earlier render failed. Until the job is done the image
+        # is served as the latest variant already rendered, requests never render it a second time
+        paths = variant_store.prefix_paths(file_path, steps)
+        variant_store.clear_errors(paths)
+        variant_store.start_rendering(paths[-1])
+
+        def rendered(job, path):
+            # The worker reports where the render time went, record it under this endpoint
+            variant_store.finish_rendering(paths[-1])
+            metrics.observe_job('views.modify_image', job)
+
+        def failed(job, error):
+            # Failed renders are remembered, the image is then shown without the edit
+            variant_store.record_error(paths[-1], error)
+            variant_store.finish_rendering(paths[-1])
+
+        try:
+            job = job_queue.submit(render_variant, file_path, steps, paths, variant_store.policy,
+                                   on_done=rendered, on_error=failed)
+        except QueueFull:
+            variant_store.finish_rendering(paths[-1])
+            db.session.rollback()
+            if wants_json():
+                return jsonify(error='Too many edits are queued, try again shortly'), 429
+            flash('Too many edits are queued, try again shortly', category='danger')
+            return render_modify_image_page(429)
+
+    db.session.commit()
+    variant_store.discard(file_path, discarded, keep=history.operations, shared=shared_operations(filename))
+
+    if wants_json():
+        if job is None:
+            return jsonify(history_state(history))
+        return jsonify(job), 202, {'Location': url_for('views.job_status', job_id=job['id'])}
+
+    # Return a success message
+    flash(f'Image {filename} queued for modification', category='success')
+    return redirect(url_for('views.modify_image_page'))
+
+
+@views.route("/modify-images", methods=["POST"])
+@login_required
+def modify_images():
+    # Apply one set of manipulations to several images and stream the results back as a ZIP
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    filenames = list(dict.fromkeys(request.form.getlist('filenames')))
+
+    # Validate the request once for the whole batch
+    error = None
+    if not filenames:
+        error = 'Select at least one image'
     else:
-        flash(f'The image "{filename}" was not found', category='danger')
-        return redirect(url_for('views.modify_image_page'))
\ No newline at end of file
+        # Only plain upload names are accepted, anything a path could be smuggled through counts as not found
+        missing = [name for name in filenames
+                   if secure_filename(name) != name or not os.path.isfile(os.path.join(upload_folder, name))]
+        if missing:
+            error = f'The images {", ".join(missing)} were not found'
+        else:
+            plan, error = validate_manipulations(request.form)
+
+    if error:
+        if wants_json():
+            return jsonify(error=error), 400
+        flash(error, category='danger')
+        return redirect(url_for('views.modify_image_page'))
+
+    # Record the edit in every image history, like modify_image does
+    renders = []
+    discarded = []
+    for filename in filenames:
+        file_path = os.path.join(upload_folder, filename)
+        history, previous = append_edit(filename, plan)
+        discarded.append((file_path, previous, history.operations))
+
+        steps = normalize_operations(history.operations)
+        renders.append((filename, file_path, steps, variant_store.prefix_paths(file_path, steps)))
+
+    # Refuse the whole batch when one of its edits would not fit the memory budget
+    for filename, file_path, steps, _ in renders:
+        if not steps:
+            continue
+        try:
+            variant_store.check_memory(file_path, steps)
+        except MemoryBudgetExceeded as error:
+            db.session.rollback()
+            if wants_json():
+                return jsonify(error=f'{filename}: {error}'), 413
+            flash(f'{filename}: {error}', category='danger')
+            return render_modify_image_page(413)
+
+    # Fan the renders out over every worker process, images that end up unchanged are sent as they are
+    pending = [(file_path, steps, paths, variant_store.policy) for _, file_path, steps, paths in renders if steps]
+    rendered = [filename for filename, _, steps, _ in renders if steps]
+    unchanged = [(filename, file_path) for filename, file_path, steps, _ in renders if not steps]
+    for _, _, paths, _ in pending:
+        variant_store.clear_errors(paths)
+        variant_store.start_rendering(paths[-1])
+    try:
+        results = job_queue.map_unordered(render_variant, pending)
+    except QueueFull:
+        for _, _, paths, _ in pending:
+            variant_store.finish_rendering(paths[-1])
+        db.session.rollback()
+        if wants_json():
+            return jsonify(error='Too many edits are queued, try again shortly'), 429
+        flash('Too many edits are queued, try again shortly', category='danger')
+        return render_modify_image_page(429)
+
+    db.session.commit()
+    for filename, (file_path, previous, operations) in zip(filenames, discarded):
+        variant_store.discard(file_path, previous, keep=operations, shared=shared_operations(filename))
+
+    def entries():
+        try:
+            yield from unchanged
+            # Every image goes into the archive as soon as its worker is done with it
+            for index, path, render_error in results:
+                if render_error is not None:
+                    variant_store.record_error(pending[index][2][-1], render_error)
+                variant_store.finish_rendering(pending[index][2][-1])
+                if render_error is None:
+                    yield rendered[index], path
+                else:
+                    yield f'{rendered[index]}.error.txt', str(render_error).encode()
+        finally:
+            # The client went away and the rest of the batch was cancelled, requests may render it again
+            for _, _, paths, _ in pending:
+                variant_store.finish_rendering(paths[-1])
+
+    return Response(stream_zip(entries()), mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename=modified_images.zip'})
+
+
+@views.route("/jobs/<job_id>", methods=["GET"])
+@login_required
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify(error=f'Job "{job_id}" was not found'), 404
+    return jsonify(job)
+
+
+@views.route("/metrics", methods=["GET"])
+def metrics_page():
+    # Prometheus scrape target, only answered to the addresses in METRICS_ALLOWED_ADDRESSES and to
+    # requests carrying METRICS_TOKEN. Nothing is allowed by default
+    token = current_app.config['METRICS_TOKEN']
+    authorization = request.headers.get('Authorization', '')
+    allowed = request.remote_addr in current_app.config['METRICS_ALLOWED_ADDRESSES']
+    if token and hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode()):
+        allowed = True
+    if not allowed:
+        abort(404)
+
+    users = user_cache.stats()
+    passwords = password_hasher.stats()
+    extra = [
+        ('image_jobs_pending', 'gauge', 'Edit jobs queued or running on the worker pool', job_queue.pending()),
+        ('user_cache_hits_total', 'counter', 'Logged in users loaded from the user cache', users['hits']),
+        ('user_cache_misses_total', 'counter', 'Logged in users loaded from the database', users['misses']),
+        ('user_cache_invalidations_total', 'counter', 'Cached users dropped because their row changed', users['invalidations']),
+        ('user_cache_entries', 'gauge', 'Users currently cached', users['entries']),
+        ('password_hashes_total', 'counter', 'Passwords hashed', passwords['hashed']),
+        ('password_verifications_total', 'counter', 'Passwords verified', passwords['verified']),
+        ('password_hash_pending', 'gauge', 'Password hashes queued or running', passwords['pending']),
+        ('password_hash_queue_seconds_total', 'counter', 'Time password hashes waited for a hasher thread', f'{passwords["queue_seconds"]:.6f}'),
+        ('password_hash_run_seconds_total', 'counter', 'Time spent hashing and verifying passwords', f'{passwords["run_seconds"]:.6f}'),
+    ]
+    return Response(metrics.render(extra), mimetype='text/plain; version=0.0.4')
+
+
+@views.route("/image-history/<filename>", methods=["GET"])
+@login_required
+def image_history(filename):
+    history = EditHistory.query.filter_by(filename=filename).first()
+    if history is None:
+        return jsonify(filename=filename, operations=[], position=0)
+    return jsonify(history_state(history))
+
+
+@views.route("/undo-image/<filename>", methods=["POST"])
+@login_required
+def undo_image(filename):
+    return move_history(filename, -1, 'Nothing to undo', 'undone')
+
+
+@views.route("/redo-image/<filename>", methods=["POST"])
+@login_required
+def redo_image(filename):
+    return move_history(filename, 1, 'Nothing to redo', 'redone')
+
+
+def move_history(filename, offset, empty_message, done_word):
+    # Undo and redo only move the history position, the variant for the new position is either
+    # already cached or rendered the next time the image is viewed
+    history = EditHistory.query.filter_by(filename=filename).first()
+    if history is None or not 0 <= history.position + offset <= len(history.operations):
+        if wants_json():
+            return jsonify(error=empty_message), 409
+        flash(empty_message, category='danger')
+        return redirect(url_for('views.modify_image_page'))
+
+    history.position += offset
+    db.session.commit()
+
+    if wants_json():
+        return jsonify(history_state(history))
+    flash(f'Last edit of {filename} {done_word}', category='success')
+    return redirect(url_for('views.modify_image_page'))
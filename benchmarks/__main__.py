@@ -0,0 +1,67 @@
+from . import report, routes, transforms
+from .images import EXTENSIONS, encoded_image
+import argparse
+import sys
+import tempfile
+
+SUITES = {'routes': routes.run, 'transforms': transforms.run}
+
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description='Benchmark the image routes and transforms on synthetic images')
+    parser.add_argument('--sizes', default='0.1,1,5,20,50',
+                        help='comma separated image sizes in megapixels (default: %(default)s)')
+    parser.add_argument('--formats', default='png,jpeg',
+                        help='comma separated image formats (default: %(default)s)')
+    parser.add_argument('--suites', default='routes,transforms',
+                        help='comma separated suites to run (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per case (default: %(default)s)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results with this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown against the baseline counted as a regression (default: %(default)s)')
+    parser.add_argument('--metric', default='p50_ms', help='metric compared with the baseline (default: %(default)s)')
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    arguments = parse_arguments(arguments)
+
+    sizes = [float(size) for size in arguments.sizes.split(',')]
+    formats = [image_format.upper() for image_format in arguments.formats.split(',')]
+    suites = arguments.suites.split(',')
+    for image_format in formats:
+        if image_format not in EXTENSIONS:
+            sys.exit(f'Unknown format {image_format}, choose from {", ".join(EXTENSIONS)}')
+    for suite in suites:
+        if suite not in SUITES:
+            sys.exit(f'Unknown suite {suite}, choose from {", ".join(SUITES)}')
+
+    # The same seed always gives the same images, so runs on different commits are comparable
+    images = [(image_format, f'{size:g}', encoded_image(image_format, size))
+              for image_format in formats for size in sizes]
+
+    results = {}
+    for suite in suites:
+        with tempfile.TemporaryDirectory(prefix=f'benchmark-{suite}-') as folder:
+            results.update(SUITES[suite](folder, images, arguments.repeat))
+
+    result = {'meta': report.metadata(vars(arguments)), 'results': results}
+    report.print_table(result)
+
+    if arguments.output:
+        report.save(arguments.output, result)
+
+    if arguments.baseline:
+        regressions = report.compare(result, report.load(arguments.baseline), arguments.threshold, arguments.metric)
+        for case, previous, current, change in regressions:
+            print(f'REGRESSION {case}: {arguments.metric} {previous:.2f} -> {current:.2f} (+{change:.0%})')
+        if regressions:
+            return 1
+        print(f'No {arguments.metric} regressions above {arguments.threshold:.0%} against {arguments.baseline}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,41 @@
+from PIL import Image
+import io
+import math
+import random
+
+# Seed of the synthetic images, the same seed always produces the same bytes
+SEED = 1234
+
+# File extension of every benchmarked format
+EXTENSIONS = {'PNG': '.png', 'JPEG': '.jpg'}
+
+
+def dimensions(megapixels):
+    # Width and height of a 4:3 image with about megapixels million pixels
+    width = max(1, round(math.sqrt(megapixels * 1_000_000 * 4 / 3)))
+    height = max(1, round(width * 3 / 4))
+    return width, height
+
+
+def synthetic_image(megapixels, seed=SEED):
+    # Photo-like RGB test image: smooth colour gradients with seeded noise on top, so it neither
+    # compresses to nothing like a flat image nor is pure noise
+    size = dimensions(megapixels)
+    generator = random.Random(seed)
+
+    noise = Image.frombytes('RGB', (256, 192), generator.randbytes(256 * 192 * 3))
+    noise = noise.resize(size, Image.Resampling.BICUBIC)
+
+    red = Image.linear_gradient('L').resize(size)
+    green = Image.radial_gradient('L').resize(size)
+    blue = Image.linear_gradient('L').rotate(90).resize(size)
+    gradient = Image.merge('RGB', (red, green, blue))
+
+    return Image.blend(gradient, noise, 0.35)
+
+
+def encoded_image(image_format, megapixels, seed=SEED):
+    # Synthetic image encoded with Pillow's default settings for image_format
+    buffer = io.BytesIO()
+    synthetic_image(megapixels, seed).save(buffer, format=image_format)
+    return buffer.getvalue()
@@ -0,0 +1,135 @@
+import json
+import math
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+
+import PIL
+
+
+def measure(function, repeat, warmup=1, setup=None):
+    # Time repeat calls of function after warmup untimed ones, then run it once more under
+    # tracemalloc for its Python allocation peak. Pillow's pixel buffers are allocated in C and
+    # do not show up in tracemalloc, the peak resident set size covers them. setup runs untimed
+    # before every call
+    setup = setup or (lambda: None)
+    for _ in range(warmup):
+        setup()
+        function()
+
+    reset_peak_rss()
+    timings = []
+    elapsed = 0
+    for _ in range(repeat):
+        setup()
+        call_started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - call_started)
+        elapsed += timings[-1]
+    rss = peak_rss()
+
+    setup()
+    tracemalloc.start()
+    try:
+        function()
+        python_peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return summarize(timings, elapsed, python_peak, rss)
+
+
+def summarize(timings, elapsed, python_peak, rss):
+    ordered = sorted(timings)
+    return {
+        'n': len(ordered),
+        'throughput_per_s': len(ordered) / elapsed if elapsed else None,
+        'mean_ms': sum(ordered) / len(ordered) * 1000,
+        'p50_ms': percentile(ordered, 50) * 1000,
+        'p95_ms': percentile(ordered, 95) * 1000,
+        'p99_ms': percentile(ordered, 99) * 1000,
+        'tracemalloc_peak_bytes': python_peak,
+        'peak_rss_bytes': rss,
+    }
+
+
+def percentile(ordered, percent):
+    # Nearest-rank percentile of an already sorted list
+    rank = max(1, math.ceil(percent / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def reset_peak_rss():
+    # Linux lets a process reset its resident set high-water mark, elsewhere the peak stays process-wide
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    # Peak resident set size in bytes since the last reset_peak_rss
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maximum = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maximum if sys.platform == 'darwin' else maximum * 1024
+
+
+def metadata(arguments):
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'arguments': arguments,
+    }
+
+
+def save(path, report):
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare(report, baseline, threshold, metric='p50_ms'):
+    # Cases whose metric got worse than the baseline by more than threshold (0.2 = 20 %).
+    # Returns a list of (case, baseline value, current value, relative change)
+    regressions = []
+    for case, result in sorted(report['results'].items()):
+        previous = baseline['results'].get(case)
+        if not previous or not previous.get(metric):
+            continue
+        change = result[metric] / previous[metric] - 1
+        if change > threshold:
+            regressions.append((case, previous[metric], result[metric], change))
+    return regressions
+
+
+def print_table(report):
+    header = f'{"case":<48} {"n":>4} {"ops/s":>9} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"py peak":>10} {"rss peak":>10}'
+    print(header)
+    print('-' * len(header))
+    for case, result in sorted(report['results'].items()):
+        print(f'{case:<48} {result["n"]:>4} {result["throughput_per_s"]:>9.1f} {result["p50_ms"]:>9.2f} '
+              f'{result["p95_ms"]:>9.2f} {result["p99_ms"]:>9.2f} {_megabytes(result["tracemalloc_peak_bytes"]):>10} '
+              f'{_megabytes(result["peak_rss_bytes"]):>10}')
+
+
+def _megabytes(value):
+    return f'{value / 1024 / 1024:.1f}M'
@@ -0,0 +1,140 @@
+from ImageManipulation import create_app, db, job_queue
+from ImageManipulation.models import User
+from .images import EXTENSIONS
+from .report import measure
+import io
+import itertools
+import os
+import time
+
+# How long a queued edit may take before the benchmark gives up on it
+JOB_TIMEOUT = 300
+
+
+def benchmark_app(folder):
+    # App with every file and the database inside folder, so runs never touch the real uploads
+    return create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(folder, 'benchmark.db'),
+        'UPLOAD_FOLDER': os.path.join(folder, 'uploads'),
+        'BLOB_FOLDER': os.path.join(folder, 'uploads', '.blobs'),
+        'THUMBNAIL_FOLDER': os.path.join(folder, 'cache', 'thumbnails'),
+        'VARIANT_FOLDER': os.path.join(folder, 'cache', 'variants'),
+        'SENDFILE_ROOT': folder,
+        'WTF_CSRF_ENABLED': False,
+    })
+
+
+def logged_in_client(app, username='benchmark', password='benchmark'):
+    with app.app_context():
+        if User.query.filter_by(username=username).first() is None:
+            user = User(username=username, email=f'{username}@example.com')
+            user.set_password(password)
+            db.session.add(user)
+            db.session.commit()
+
+    client = app.test_client()
+    response = client.post('/login', data={'username': username, 'password': password})
+    if response.status_code != 302:
+        raise RuntimeError(f'Benchmark user could not log in ({response.status_code})')
+    return client
+
+
+def run(folder, images, repeat):
+    # Benchmark the upload, list, download, preview and modify routes with every (format, megapixels, bytes)
+    # in images. Returns {case name: result}
+    app = benchmark_app(folder)
+    client = logged_in_client(app)
+    names = itertools.count()
+    results = {}
+
+    try:
+        for image_format, megapixels, data in images:
+            label = f'{image_format.lower()}:{megapixels}mp'
+            extension = EXTENSIONS[image_format]
+
+            def upload():
+                filename = f'upload-{next(names)}{extension}'
+                response = client.post('/upload-image', data={'image': (io.BytesIO(data), filename)},
+                                       content_type='multipart/form-data')
+                _expect(response, 302)
+
+            results[f'route:upload_image:{label}'] = measure(upload, repeat)
+
+            # One image that the remaining routes work on
+            filename = f'subject-{next(names)}{extension}'
+            _expect(client.post('/upload-image', data={'image': (io.BytesIO(data), filename)},
+                                content_type='multipart/form-data'), 302)
+
+            def download():
+                response = client.get(f'/download-image/{filename}')
+                _expect(response, 200)
+                # Drain the body, send_file streams it lazily
+                response.get_data()
+                response.close()
+
+            results[f'route:download_image:{label}'] = measure(download, repeat)
+
+            etag = client.get(f'/download-image/{filename}').headers['ETag']
+
+            def revalidate():
+                _expect(client.get(f'/download-image/{filename}', headers={'If-None-Match': etag}), 304)
+
+            results[f'route:download_image_304:{label}'] = measure(revalidate, repeat)
+
+            # Live previews of an edit while typing, on the (already cached) proxy of the image
+            contrasts = itertools.cycle(range(1, 100))
+
+            def preview():
+                response = client.get(f'/preview-image/{filename}?rotate=30&contrast={next(contrasts) / 10}'
+                                      f'&saturation=1.2')
+                _expect(response, 200)
+
+            _expect(client.get(f'/preview-image/{filename}?contrast=1.5'), 200)
+            results[f'route:preview_image:{label}'] = measure(preview, repeat)
+
+            # Every edit uses a new angle so no run is answered from the variant cache, and the
+            # previous one is undone first so the history (and the work per edit) does not grow
+            angles = itertools.cycle(range(1, 360))
+
+            def undo():
+                client.post(f'/undo-image/{filename}')
+
+            def modify():
+                response = client.post(f'/modify-image/{filename}', headers={'Accept': 'application/json'},
+                                       data={'width': '640', 'height': '480', 'rotate': str(next(angles)),
+                                             'contrast': '1.5'})
+                _expect(response, 202)
+                _wait_for_job(client, response.get_json()['id'])
+
+            results[f'route:modify_image:{label}'] = measure(modify, repeat, setup=undo)
+
+        def list_images():
+            _expect(client.get('/list-images'), 200)
+
+        def list_images_page():
+            _expect(client.get('/list-images-page?page=2&sort=size&order=desc'), 200)
+
+        results['route:list_images'] = measure(list_images, repeat)
+        results['route:list_images_page'] = measure(list_images_page, repeat)
+    finally:
+        job_queue.shutdown()
+
+    return results
+
+
+def _wait_for_job(client, job_id):
+    deadline = time.monotonic() + JOB_TIMEOUT
+    while time.monotonic() < deadline:
+        job = client.get(f'/jobs/{job_id}').get_json()
+        if job['status'] == 'finished':
+            return
+        if job['status'] == 'failed':
+            raise RuntimeError(f'Benchmark edit failed: {job["error"]}')
+        time.sleep(0.005)
+    raise RuntimeError(f'Benchmark edit did not finish within {JOB_TIMEOUT} seconds')
+
+
+def _expect(response, status_code):
+    if response.status_code != status_code:
+        raise RuntimeError(f'{response.request.method} {response.request.path} answered '
+                           f'{response.status_code}, expected {status_code}')
@@ -0,0 +1,93 @@
+from flask import Flask
+from ImageManipulation.encoding import PRESETS, encode, webp_supported
+from ImageManipulation.pipeline import TransformPlan, apply_plan, render
+from ImageManipulation.thumbnails import ThumbnailCache
+from PIL import Image, ImageEnhance, ImageFilter, ImageOps
+from .images import EXTENSIONS
+from .report import measure
+import io
+import os
+
+# Every manipulation on its own and all of them fused, as the modify route would plan them
+PLANS = {
+    'resize': TransformPlan(size=(640, 480)),
+    'rotate': TransformPlan(rotate=37),
+    'contrast': TransformPlan(contrast=1.5),
+    'fused': TransformPlan(size=(640, 480), rotate=37, contrast=1.5),
+    'adjust': TransformPlan(brightness=1.1, contrast=1.3, saturation=1.4),
+    'equalize': TransformPlan(equalize=True),
+    'blur': TransformPlan(blur=4),
+}
+
+
+def enhance_chain(image):
+    # The 'adjust' plan as ImageEnhance calls one after another, what the adjustment engine replaces
+    image = ImageEnhance.Brightness(image).enhance(1.1)
+    image = ImageEnhance.Contrast(image).enhance(1.3)
+    return ImageEnhance.Color(image).enhance(1.4)
+
+
+def run(folder, images, repeat):
+    # Micro-benchmark decoding, each transform, encoding and thumbnail building for every
+    # (format, megapixels, bytes) in images. Returns {case name: result}
+    app = Flask(__name__)
+    app.config['THUMBNAIL_FOLDER'] = os.path.join(folder, 'thumbnails')
+    app.config['THUMBNAIL_CACHE_MAX_BYTES'] = 64 * 1024 * 1024
+    app.config['THUMBNAIL_PRESET'] = 'size'
+    thumbnails = ThumbnailCache(app)
+    results = {}
+
+    for image_format, megapixels, data in images:
+        label = f'{image_format.lower()}:{megapixels}mp'
+        filename = f'transform-{megapixels}mp{EXTENSIONS[image_format]}'
+        path = os.path.join(folder, filename)
+        with open(path, 'wb') as file:
+            file.write(data)
+
+        def decode():
+            with Image.open(path) as image:
+                image.load()
+
+        results[f'transform:decode:{label}'] = measure(decode, repeat)
+
+        # The transforms themselves run on an already decoded image
+        with Image.open(path) as image:
+            decoded = image.copy()
+
+        for name, plan in PLANS.items():
+            results[f'transform:{name}:{label}'] = measure(lambda plan=plan: apply_plan(decoded, plan), repeat)
+
+        # The same adjustments, equalization and blur straight with Pillow
+        rgb = decoded.convert('RGB')
+        results[f'transform:adjust_imageenhance:{label}'] = measure(lambda: enhance_chain(rgb), repeat)
+        results[f'transform:equalize_imageops:{label}'] = measure(lambda: ImageOps.equalize(rgb), repeat)
+        results[f'transform:blur_imagefilter:{label}'] = measure(lambda: rgb.filter(ImageFilter.GaussianBlur(4)), repeat)
+
+        # The large-image mode rotates tile by tile
+        results[f'transform:rotate_tiled:{label}'] = measure(lambda: apply_plan(decoded, PLANS['rotate'], 512), repeat)
+
+        # render() includes the decode, and the reduced JPEG decode for downscales
+        results[f'transform:render_fused:{label}'] = measure(lambda: render(path, PLANS['fused']), repeat)
+
+        def encode_default():
+            decoded.save(io.BytesIO(), format=image_format)
+
+        results[f'transform:encode:{label}'] = measure(encode_default, repeat)
+
+        # Every encoding preset, in the image's own format and as WebP
+        output_path = os.path.join(folder, 'encoded')
+        formats = [image_format] + (['WEBP'] if webp_supported() else [])
+        for output_format in formats:
+            for preset in PRESETS:
+                case = f'transform:encode_{preset}_{output_format.lower()}:{label}'
+                results[case] = measure(lambda output_format=output_format, preset=preset:
+                                        encode(decoded, output_path, output_format, preset), repeat)
+
+        for output_format in formats:
+            def thumbnail(output_format=output_format):
+                thumbnails.get(path, filename, 200, output_format)
+
+            results[f'transform:thumbnail_{output_format.lower()}:{label}'] = measure(
+                thumbnail, repeat, setup=lambda: thumbnails.invalidate(filename))
+
+    return results
@@ -0,0 +1,50 @@
+from ImageManipulation import create_app, db, job_queue, password_hasher
+from ImageManipulation.models import User
+from PIL import Image
+import io
+import os
+import pytest
+
+
+@pytest.fixture
+def app(tmp_path):
+    # App with every file and the database inside tmp_path, so tests never touch the real uploads
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmp_path, 'test.db'),
+        'UPLOAD_FOLDER': os.path.join(tmp_path, 'uploads'),
+        'BLOB_FOLDER': os.path.join(tmp_path, 'uploads', '.blobs'),
+        'THUMBNAIL_FOLDER': os.path.join(tmp_path, 'cache', 'thumbnails'),
+        'VARIANT_FOLDER': os.path.join(tmp_path, 'cache', 'variants'),
+        'SENDFILE_ROOT': str(tmp_path),
+        'WTF_CSRF_ENABLED': False,
+    })
+    yield app
+    job_queue.shutdown()
+    password_hasher.shutdown()
+
+
+@pytest.fixture
+def client(app):
+    with app.app_context():
+        user = User(username='tester', email='tester@example.com')
+        user.set_password('secret')
+        db.session.add(user)
+        db.session.commit()
+
+    client = app.test_client()
+    assert client.post('/login', data={'username': 'tester', 'password': 'secret'}).status_code == 302
+    return client
+
+
+@pytest.fixture
+def upload(client):
+    # Upload a generated image under filename through the upload route
+    def upload(filename, size=(64, 48), mode='RGB'):
+        data = io.BytesIO()
+        image_format = Image.registered_extensions()[os.path.splitext(filename)[1]]
+        Image.new(mode, size, 'red' if mode == 'RGB' else 1).save(data, image_format)
+        response = client.post('/upload-image', data={'image': (io.BytesIO(data.getvalue()), filename)},
+                               content_type='multipart/form-data')
+        assert response.status_code == 302
+        return filename
+    return upload
@@ -0,0 +1,48 @@
+from ImageManipulation.catalog import reconcile
+from PIL import Image
+import os
+import pytest
+
+
+def test_reconcile_counts_added_updated_and_removed_files(app, upload):
+    upload('kept.png')
+    upload('changed.png')
+    upload('gone.png')
+    folder = app.config['UPLOAD_FOLDER']
+
+    # Files changed behind the app's back
+    Image.new('RGB', (10, 10)).save(os.path.join(folder, 'new.png'))
+    os.remove(os.path.join(folder, 'changed.png'))
+    Image.new('RGB', (30, 20)).save(os.path.join(folder, 'changed.png'))
+    os.remove(os.path.join(folder, 'gone.png'))
+    with open(os.path.join(folder, 'broken.png'), 'wb') as file:
+        file.write(b'not an image')
+    with open(os.path.join(folder, 'notes.txt'), 'w') as file:
+        file.write('not an upload')
+
+    with app.app_context():
+        assert reconcile(folder) == (1, 1, 1)
+        # Nothing changed since
+        assert reconcile(folder) == (0, 0, 0)
+
+
+@pytest.mark.parametrize('query, expected', [
+    ({'per_page': '2'}, ['a.png', 'b.png']),
+    ({'per_page': '2', 'page': '2'}, ['c.png', 'd.png']),
+    ({'per_page': '2', 'page': '3'}, ['e.png']),
+    ({'sort': 'name', 'order': 'desc', 'per_page': '3'}, ['e.png', 'd.png', 'c.png']),
+    ({'sort': 'size', 'order': 'desc', 'per_page': '2'}, ['c.png', 'a.png']),
+])
+def test_list_images_pages_and_sorts(app, client, query, expected):
+    # Noise compresses badly, so the bigger the image the bigger the file
+    folder = app.config['UPLOAD_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    for filename, size in (('a.png', 40), ('b.png', 10), ('c.png', 50), ('d.png', 20), ('e.png', 30)):
+        Image.frombytes('RGB', (size, size), os.urandom(size * size * 3)).save(os.path.join(folder, filename))
+    with app.app_context():
+        reconcile(folder)
+
+    response = client.get('/list-images', query_string=query)
+
+    assert response.status_code == 200
+    assert response.get_json() == expected
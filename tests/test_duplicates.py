@@ -0,0 +1,74 @@
+from ImageManipulation import db
+from ImageManipulation.models import Image
+from ImageManipulation.similarity import duplicate_clusters, hamming, similar_hashes, store_hash, BAND_BITS, MAX_DISTANCE
+import random
+
+
+def add_hashes(values):
+    # Catalog entries named after their position in values, each with its own content
+    for number, value in enumerate(values):
+        content_hash = f'{number:064x}'
+        db.session.add(Image(filename=f'{number}.png', content_hash=content_hash))
+        store_hash(content_hash, value)
+    db.session.commit()
+
+
+def flip_bits(value, count):
+    # value with count bits flipped, spread over every band so no band matches exactly
+    for number in range(count):
+        value ^= 1 << (number % 4 * BAND_BITS + number // 4)
+    return value
+
+
+def brute_force_clusters(values, distance):
+    groups = [{number} for number in range(len(values))]
+    for first in range(len(values)):
+        for second in range(first + 1, len(values)):
+            if hamming(values[first], values[second]) <= distance:
+                merged = next(group for group in groups if first in group)
+                other = next(group for group in groups if second in group)
+                if merged is not other:
+                    merged |= other
+                    groups.remove(other)
+    clusters = [sorted(f'{number}.png' for number in group) for group in groups if len(group) > 1]
+    return sorted(clusters, key=lambda names: (-len(names), names[0]))
+
+
+def test_clusters_match_a_comparison_of_every_pair(app):
+    generator = random.Random(4)
+    values = []
+    for _ in range(150):
+        value = generator.getrandbits(64)
+        values.append(value)
+        # Near copies a few bits away
+        for _ in range(generator.randrange(3)):
+            for _ in range(generator.randrange(8)):
+                value ^= 1 << generator.randrange(64)
+            values.append(value)
+
+    with app.app_context():
+        add_hashes(values)
+        for distance in (0, 3, 6, MAX_DISTANCE):
+            clusters, unhashed = duplicate_clusters(distance)
+            assert unhashed == 0
+            assert clusters == brute_force_clusters(values, distance)
+
+
+def test_distance_is_capped(client):
+    response = client.get('/duplicates', query_string={'distance': '16'})
+
+    assert response.status_code == 200
+    assert response.get_json()['distance'] == MAX_DISTANCE
+
+
+def test_similar_hashes_finds_hashes_within_distance(app):
+    base = 0x0123456789abcdef
+    values = [base] + [flip_bits(base, count) for count in (3, 7, 9)]
+
+    with app.app_context():
+        add_hashes(values)
+        found = similar_hashes(base, MAX_DISTANCE)
+        assert found == {f'{0:064x}': 0, f'{1:064x}': 3, f'{2:064x}': 7}
+        assert similar_hashes(base, 3) == {f'{0:064x}': 0, f'{1:064x}': 3}
+        # Distances past MAX_DISTANCE are capped, the 9 bit hash is still not found
+        assert similar_hashes(base, 16) == found
@@ -0,0 +1,73 @@
+from ImageManipulation.jobs import JobQueue, QueueFull
+import os
+import pytest
+import threading
+import time
+
+
+def make_queue(max_pending=8):
+    queue = JobQueue()
+    queue.max_workers = 1
+    queue.max_pending = max_pending
+    queue.history_limit = 100
+    return queue
+
+
+def test_failed_job_calls_on_error(tmp_path):
+    queue = make_queue()
+    failed = threading.Event()
+    errors = []
+
+    def on_error(job, error):
+        errors.append((job['status'], error))
+        failed.set()
+
+    try:
+        queue.submit(os.remove, str(tmp_path / 'missing'), on_error=on_error)
+        assert failed.wait(30)
+    finally:
+        queue.shutdown()
+
+    status, error = errors[0]
+    assert status == 'failed'
+    assert isinstance(error, FileNotFoundError)
+
+
+def test_batch_never_goes_over_the_queue_limit():
+    queue = make_queue(max_pending=2)
+    try:
+        results = queue.map_unordered(time.sleep, [(0.02,)] * 10)
+        assert queue.pending() == 2
+
+        indexes = []
+        for index, result, error in results:
+            assert error is None
+            assert queue.pending() <= 2
+            indexes.append(index)
+    finally:
+        queue.shutdown()
+
+    assert sorted(indexes) == list(range(10))
+    assert queue.pending() == 0
+
+
+def test_batch_is_refused_when_the_queue_is_full():
+    queue = make_queue(max_pending=1)
+    try:
+        queue.submit(time.sleep, 0.5)
+        with pytest.raises(QueueFull):
+            queue.map_unordered(time.sleep, [(0,)])
+    finally:
+        queue.shutdown()
+
+
+def test_batch_starts_a_fresh_pool_after_a_worker_died():
+    queue = make_queue()
+    failed = threading.Event()
+    try:
+        queue.submit(os._exit, 1, on_error=lambda job, error: failed.set())
+        assert failed.wait(30)
+
+        assert list(queue.map_unordered(pow, [(2, 3)])) == [(0, 8, None)]
+    finally:
+        queue.shutdown()
@@ -0,0 +1,22 @@
+import pytest
+
+
+def test_metrics_are_off_by_default(client):
+    assert client.get('/metrics').status_code == 404
+
+
+def test_metrics_for_allowed_addresses(app, client):
+    app.config['METRICS_ALLOWED_ADDRESSES'] = ('127.0.0.1',)
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert 'image_jobs_pending' in response.get_data(as_text=True)
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '10.0.0.5'}).status_code == 404
+
+
+@pytest.mark.parametrize('authorization, status', [('Bearer secret-token', 200), ('Bearer wrong', 404), ('', 404)])
+def test_metrics_token(app, client, authorization, status):
+    app.config['METRICS_TOKEN'] = 'secret-token'
+
+    response = client.get('/metrics', headers={'Authorization': authorization}, environ_base={'REMOTE_ADDR': '10.0.0.5'})
+    assert response.status_code == status
@@ -0,0 +1,144 @@
+from ImageManipulation import job_queue, variant_store
+from ImageManipulation.variants import normalize_operations
+from PIL import Image
+import io
+import os
+import pytest
+import re
+import time
+
+
+def wait_for_job(client, job):
+    # Poll the job status until the worker is done with it
+    for _ in range(200):
+        job = client.get(f'/jobs/{job["id"]}').get_json()
+        if job['status'] in ('finished', 'failed'):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f'Job {job["id"]} did not finish')
+
+
+@pytest.mark.parametrize('field', ['width', 'height', 'rotate', 'contrast', 'brightness', 'saturation', 'gamma',
+                                   'levels_black', 'levels_white', 'blur'])
+@pytest.mark.parametrize('value', ['nan', 'inf', '-inf', 'NaN'])
+def test_non_finite_values_are_refused(client, upload, field, value):
+    upload('photo.png')
+    data = {'width': '32', 'height': '24', field: value}
+
+    response = client.post('/modify-image/photo.png', data=data, headers={'Accept': 'application/json'})
+
+    assert response.status_code == 400
+    assert client.get('/image-history/photo.png').get_json()['operations'] == []
+
+
+def test_valid_edit_is_queued(client, upload):
+    upload('photo.png')
+
+    response = client.post('/modify-image/photo.png', data={'blur': '2', 'brightness': '1.5'},
+                           headers={'Accept': 'application/json'})
+
+    assert response.status_code == 202
+    assert len(client.get('/image-history/photo.png').get_json()['operations']) == 1
+
+
+@pytest.mark.parametrize('mode', ['P', '1'])
+def test_palette_and_bilevel_images_are_downscaled(client, upload, mode):
+    upload('drawing.png', size=(360, 360), mode=mode)
+
+    response = client.post('/modify-image/drawing.png', data={'width': '90', 'height': '60'},
+                           headers={'Accept': 'application/json'})
+
+    assert wait_for_job(client, response.get_json())['status'] == 'finished'
+    response = client.get('/download-image/drawing.png')
+    assert Image.open(io.BytesIO(response.get_data())).size == (90, 60)
+
+
+def test_failed_edit_is_left_out(app, client, upload):
+    upload('photo.png', size=(400, 300))
+    first = client.post('/modify-image/photo.png', data={'width': '200', 'height': '150', 'brightness': '1.2'},
+                        headers={'Accept': 'application/json'})
+    assert wait_for_job(client, first.get_json())['status'] == 'finished'
+    second = client.post('/modify-image/photo.png', data={'width': '100', 'height': '50'},
+                         headers={'Accept': 'application/json'})
+    assert wait_for_job(client, second.get_json())['status'] == 'finished'
+
+    # Fail the second resize the way a failed job does
+    with app.app_context():
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'photo.png')
+        operations = client.get('/image-history/photo.png').get_json()['operations']
+        paths = variant_store.prefix_paths(file_path, normalize_operations(operations))
+        os.remove(paths[-1])
+        variant_store.record_error(paths[-1], OSError('broken worker'))
+
+    response = client.get('/download-image/photo.png')
+    assert response.status_code == 200
+    assert Image.open(io.BytesIO(response.get_data())).size == (200, 150)
+    assert 'broken worker' in client.get('/modify-image-page').get_data(as_text=True)
+    assert client.get('/thumbnail/photo.png').status_code == 200
+    assert client.get('/preview-image/photo.png', query_string={'blur': '1'}).status_code == 200
+
+    # Submitting the edit again retries it
+    client.post('/undo-image/photo.png', headers={'Accept': 'application/json'})
+    again = client.post('/modify-image/photo.png', data={'width': '100', 'height': '50'},
+                        headers={'Accept': 'application/json'})
+    assert wait_for_job(client, again.get_json())['status'] == 'finished'
+    response = client.get('/download-image/photo.png')
+    assert Image.open(io.BytesIO(response.get_data())).size == (100, 50)
+    assert not os.path.exists(paths[-1] + '.error')
+
+
+def test_queued_edit_is_not_rendered_by_requests(client, upload, monkeypatch):
+    upload('photo.png', size=(400, 300))
+    first = client.post('/modify-image/photo.png', data={'width': '200', 'height': '150'},
+                        headers={'Accept': 'application/json'})
+    assert wait_for_job(client, first.get_json())['status'] == 'finished'
+
+    # Keep the next job queued for good, and fail any render a request would do itself
+    monkeypatch.setattr(job_queue, 'submit', lambda *args, **kwargs: {'id': 'queued', 'status': 'queued'})
+    def render_variant(*args):
+        raise AssertionError('a request rendered a variant')
+    monkeypatch.setattr('ImageManipulation.variants.render_variant', render_variant)
+
+    assert client.post('/modify-image/photo.png', data={'width': '100', 'height': '50'},
+                       headers={'Accept': 'application/json'}).status_code == 202
+    page = client.get('/modify-image-page').get_data(as_text=True)
+    version = re.search(r'thumbnail/photo\.png\?[^"]*v=(\w+)', page).group(1)
+
+    response = client.get('/thumbnail/photo.png', query_string={'v': version})
+    assert response.status_code == 200
+    assert 'immutable' not in response.headers['Cache-Control']
+    response = client.get('/download-image/photo.png')
+    assert Image.open(io.BytesIO(response.get_data())).size == (200, 150)
+
+
+@pytest.mark.parametrize('data', [{'rotate': '0'}, {'levels_black': '0'}, {'width': '0', 'height': '0'},
+                                  {'brightness': '1', 'blur': '0'}])
+def test_edits_that_change_nothing_are_refused(client, upload, data):
+    upload('photo.png')
+
+    response = client.post('/modify-image/photo.png', data=data, headers={'Accept': 'application/json'})
+
+    assert response.status_code == 400
+    assert client.get('/image-history/photo.png').get_json()['operations'] == []
+
+
+def test_variants_shared_by_identical_uploads_are_kept(app, client, upload):
+    upload('first.png', size=(400, 300))
+    upload('second.png', size=(400, 300))
+    for filename in ('first.png', 'second.png'):
+        response = client.post(f'/modify-image/{filename}', data={'width': '200', 'height': '150'},
+                               headers={'Accept': 'application/json'})
+        assert wait_for_job(client, response.get_json())['status'] == 'finished'
+
+    with app.app_context():
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'second.png')
+        operations = client.get('/image-history/second.png').get_json()['operations']
+        variant_path = variant_store.prefix_paths(file_path, normalize_operations(operations))[-1]
+    assert os.path.exists(variant_path)
+
+    # Replacing the edit of one name and deleting it leave the other name's variant alone
+    client.post('/undo-image/first.png')
+    client.post('/modify-image/first.png', data={'rotate': '90'}, headers={'Accept': 'application/json'})
+    assert os.path.exists(variant_path)
+    client.post('/delete-image/first.png')
+    assert os.path.exists(variant_path)
@@ -0,0 +1,41 @@
+from ImageManipulation import job_queue
+import io
+import os
+import zipfile
+
+
+def test_batch_returns_a_zip_of_the_results(client, upload):
+    upload('first.png')
+    upload('second.png')
+
+    response = client.post('/modify-images', data={'filenames': ['first.png', 'second.png'], 'rotate': '90'})
+
+    assert response.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(response.get_data()))
+    assert sorted(archive.namelist()) == ['first.png', 'second.png']
+
+
+def test_batch_refuses_names_outside_the_upload_folder(app, client, upload):
+    upload('first.png')
+    secret = os.path.join(app.config['UPLOAD_FOLDER'], '..', 'secret.txt')
+    with open(secret, 'w') as file:
+        file.write('secret')
+
+    # rotate=0 is no edit at all, the files would be sent as they are
+    for name in ('../secret.txt', '../test.db', '.blobs/../first.png'):
+        response = client.post('/modify-images', data={'filenames': ['first.png', name], 'rotate': '0'},
+                               headers={'Accept': 'application/json'})
+        assert response.status_code == 400
+        assert name in response.get_json()['error']
+
+
+def test_batch_larger_than_the_queue_limit_runs(client, upload, monkeypatch):
+    monkeypatch.setattr(job_queue, 'max_pending', 2)
+    filenames = [upload(f'photo-{number}.png') for number in range(6)]
+
+    response = client.post('/modify-images', data={'filenames': filenames, 'width': '32', 'height': '24'})
+
+    assert response.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(response.get_data()))
+    assert sorted(archive.namelist()) == sorted(filenames)
+    assert job_queue.pending() == 0
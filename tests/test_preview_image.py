@@ -0,0 +1,48 @@
+from ImageManipulation import variant_store
+from PIL import Image
+import io
+import os
+import pytest
+
+
+def preview(client, filename, **params):
+    return client.get(f'/preview-image/{filename}', query_string=params)
+
+
+def test_preview_renders_the_manipulations(client, upload):
+    upload('photo.png', size=(400, 300))
+
+    response = preview(client, 'photo.png', width='200', height='100', blur='2')
+
+    assert response.status_code == 200
+    assert Image.open(io.BytesIO(response.get_data())).size == (200, 100)
+
+
+@pytest.mark.parametrize('params', [{'blur': 'nan'}, {'blur': 'inf'}, {'brightness': 'nan'},
+                                    {'width': 'nan', 'height': '10'}])
+def test_preview_refuses_non_finite_values(client, upload, params):
+    upload('photo.png')
+
+    response = preview(client, 'photo.png', **params)
+
+    assert response.status_code == 400
+    # The server is still answering
+    assert preview(client, 'photo.png', blur='1').status_code == 200
+
+
+def test_preview_never_renders_the_full_image(app, client, upload, monkeypatch):
+    upload('photo.png', size=(400, 300))
+    client.post('/modify-image/photo.png', data={'width': '200', 'height': '150'},
+                headers={'Accept': 'application/json'})
+    client.post('/modify-image/photo.png', data={'rotate': '90'}, headers={'Accept': 'application/json'})
+
+    # Pretend the queued renders have not finished, the preview must not render them itself
+    def render_variant(*args):
+        raise AssertionError('the preview rendered a variant')
+    monkeypatch.setattr('ImageManipulation.variants.render_variant', render_variant)
+    monkeypatch.setattr(variant_store, 'folder', os.path.join(app.config['VARIANT_FOLDER'], 'empty'))
+
+    response = preview(client, 'photo.png', brightness='1.2')
+
+    assert response.status_code == 200
+    assert Image.open(io.BytesIO(response.get_data())).size == (200, 150)
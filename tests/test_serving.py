@@ -0,0 +1,72 @@
+import hashlib
+import os
+import re
+
+
+def uploaded_bytes(app, filename):
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], filename), 'rb') as file:
+        return file.read()
+
+
+def test_etag_is_the_content_hash(app, client, upload):
+    upload('photo.png')
+    data = uploaded_bytes(app, 'photo.png')
+
+    response = client.get('/download-image/photo.png')
+
+    assert response.status_code == 200
+    assert response.get_data() == data
+    assert response.headers['ETag'] == f'"{hashlib.sha256(data).hexdigest()}"'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.headers['Cache-Control'] == 'no-cache, private'
+
+
+def test_matching_etag_answers_not_modified(client, upload):
+    upload('photo.png')
+    etag = client.get('/download-image/photo.png').headers['ETag']
+
+    response = client.get('/download-image/photo.png', headers={'If-None-Match': etag})
+
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    assert client.get('/download-image/photo.png', headers={'If-None-Match': '"other"'}).status_code == 200
+
+
+def test_range_answers_partial_content(app, client, upload):
+    upload('photo.png')
+    data = uploaded_bytes(app, 'photo.png')
+
+    response = client.get('/download-image/photo.png', headers={'Range': 'bytes=10-19'})
+
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 10-19/{len(data)}'
+    assert response.get_data() == data[10:20]
+
+
+def test_thumbnail_is_immutable_only_for_the_current_version(client, upload):
+    upload('photo.png')
+    page = client.get('/list-images-page').get_data(as_text=True)
+    version = re.search(r'thumbnail/photo\.png\?[^"]*v=(\w+)', page).group(1)
+
+    response = client.get('/thumbnail/photo.png', query_string={'v': version})
+    assert response.headers['Cache-Control'] == 'private, max-age=31536000, immutable'
+
+    for query in ({'v': 'outdated'}, {}):
+        response = client.get('/thumbnail/photo.png', query_string=query)
+        assert response.headers['Cache-Control'] == 'no-cache, private'
+
+
+def test_accel_redirect_leaves_the_body_to_the_proxy(app, client, upload):
+    upload('photo.png')
+    app.config['SENDFILE_MODE'] = 'x-accel-redirect'
+    data = uploaded_bytes(app, 'photo.png')
+
+    response = client.get('/download-image/photo.png')
+
+    assert response.status_code == 200
+    assert response.get_data() == b''
+    assert response.headers['X-Accel-Redirect'] == '/protected/uploads/photo.png'
+    assert response.headers['Content-Disposition'] == 'attachment; filename=photo.png'
+    assert response.headers['ETag'] == f'"{hashlib.sha256(data).hexdigest()}"'
+    etag = response.headers['ETag']
+    assert client.get('/download-image/photo.png', headers={'If-None-Match': etag}).status_code == 304
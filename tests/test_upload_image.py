@@ -0,0 +1,35 @@
+from ImageManipulation import job_queue
+from ImageManipulation.storage import FILE_MODE
+from PIL import Image
+import io
+import os
+import stat
+
+
+def test_uploads_get_the_mode_of_a_plain_file(app, upload):
+    upload('photo.png')
+    plain = os.path.join(app.config['UPLOAD_FOLDER'], 'plain')
+    open(plain, 'w').close()
+
+    mode = stat.S_IMODE(os.stat(os.path.join(app.config['UPLOAD_FOLDER'], 'photo.png')).st_mode)
+    assert mode == FILE_MODE == stat.S_IMODE(os.stat(plain).st_mode)
+
+
+def test_near_duplicates_are_reported(client, upload, monkeypatch):
+    # PNGs have no reduced decode, they are hashed on the job queue instead of in the request
+    hashed = []
+    run = job_queue.run
+
+    def recording_run(function, *args, **kwargs):
+        hashed.append(args)
+        return run(function, *args, **kwargs)
+    monkeypatch.setattr(job_queue, 'run', recording_run)
+
+    upload('photo.png', size=(400, 300))
+    data = io.BytesIO()
+    Image.new('RGB', (200, 150), 'red').save(data, 'JPEG')
+    response = client.post('/upload-image', data={'image': (io.BytesIO(data.getvalue()), 'copy.jpg')},
+                           content_type='multipart/form-data', follow_redirects=True)
+
+    assert 'copy.jpg looks like a near-duplicate of photo.png' in response.get_data(as_text=True)
+    assert [os.path.basename(args[0]) for args in hashed] == ['photo.png']
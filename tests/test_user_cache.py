@@ -0,0 +1,53 @@
+from ImageManipulation import db, user_cache
+from ImageManipulation.models import User
+
+
+class UpdatedWhileLoading:
+    # Session whose get() sees the row change (and the cache invalidated) before the load returns
+    def __init__(self, session):
+        self.session = session
+
+    def get(self, model, user_id):
+        user = self.session.get(model, user_id)
+        user_cache.invalidate(user_id)
+        return user
+
+    def merge(self, *args, **kwargs):
+        return self.session.merge(*args, **kwargs)
+
+
+def test_row_changed_during_a_load_is_not_cached(app, client):
+    with app.app_context():
+        user_id = User.query.filter_by(username='tester').first().id
+        user_cache.invalidate(user_id)
+
+        user_cache.get(UpdatedWhileLoading(db.session), User, user_id)
+        misses = user_cache.stats()['misses']
+        user_cache.get(db.session, User, user_id)
+        assert user_cache.stats()['misses'] == misses + 1
+
+        # Loads that saw no change are cached again
+        hits = user_cache.stats()['hits']
+        user_cache.get(db.session, User, user_id)
+        assert user_cache.stats()['hits'] == hits + 1
+
+
+def test_password_change_drops_the_cached_user(app, client):
+    with app.app_context():
+        user_id = User.query.filter_by(username='tester').first().id
+        old_hash = user_cache.get(db.session, User, user_id).password_hash
+        assert user_cache.get(db.session, User, user_id).password_hash == old_hash
+        invalidations = user_cache.stats()['invalidations']
+
+        user = db.session.get(User, user_id)
+        user.set_password('changed')
+        db.session.commit()
+        assert user_cache.stats()['invalidations'] == invalidations + 1
+
+    # A fresh session loads the new row, the old password no longer logs in
+    with app.app_context():
+        assert user_cache.get(db.session, User, user_id).password_hash != old_hash
+    client.get('/logout')
+    # Failed logins redirect back to the login page, successful ones to the home page
+    assert client.post('/login', data={'username': 'tester', 'password': 'secret'}).headers['Location'] == '/login'
+    assert client.post('/login', data={'username': 'tester', 'password': 'changed'}).headers['Location'] == '/'
@@ -0,0 +1,17 @@
+from ImageManipulation.pipeline import build_plan
+from ImageManipulation.variants import normalize_operations, variant_version
+
+
+def test_no_op_steps_are_dropped():
+    resize = build_plan(width=100, height=50).to_dict()
+
+    assert normalize_operations([{}, resize, build_plan(rotate=0).to_dict()]) == [resize]
+
+
+def test_consecutive_resizes_are_kept():
+    # Resampling twice gives a different image than resizing straight to the second size
+    first = build_plan(width=30, height=20).to_dict()
+    second = build_plan(width=100, height=50).to_dict()
+
+    assert normalize_operations([first, second]) == [first, second]
+    assert variant_version('content', [first, second]) != variant_version('content', [second])